@@ -0,0 +1,552 @@
+# batch.py - Tiny BASIC の一括実行
+#
+
+
+# 参照
+#
+import io
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from lark import Tree
+from lark import Token
+from tinybasic import TinyBasic
+from tinybasic import VariableView
+
+
+# 二項演算（式の値は int16 の配列で、足し算、引き算、掛け算は NumPy が 16bits で丸める）
+#
+BINARIES = {
+    'greater': lambda left, right: (left > right).astype(np.int16),
+    'greater_equal': lambda left, right: (left >= right).astype(np.int16),
+    'less': lambda left, right: (left < right).astype(np.int16),
+    'less_equal': lambda left, right: (left <= right).astype(np.int16),
+    'equal': lambda left, right: (left == right).astype(np.int16),
+    'not_equal': lambda left, right: (left != right).astype(np.int16),
+    'addition': lambda left, right: left + right,
+    'subtraction': lambda left, right: left - right,
+    'multiply': lambda left, right: left * right,
+}
+
+
+# 一括実行の状態として保存する配列
+#
+STATE = (
+    '_pcs', '_faults', '_counts', '_batch_slots', '_batch_array', 
+    '_gosub_stack', '_gosub_depth', '_for_pcs', '_for_slots', '_for_limits', '_for_steps', '_for_depth',
+)
+
+
+# 一括実行の状態の写し
+#
+class BatchSnapshot:
+
+    # コンストラクタ
+    def __init__(self, digest, arrays, generator, rounds):
+        self.digest = digest
+        self.arrays = arrays
+        self.generator = generator
+        self.rounds = rounds
+
+    # バイト列にする（NumPy の npz 形式）
+    def to_bytes(self):
+        header = json.dumps({'digest': self.digest, 'generator': self.generator, 'rounds': self.rounds})
+        file = io.BytesIO()
+        np.savez_compressed(file, header = np.frombuffer(header.encode(), np.uint8), **self.arrays)
+        return file.getvalue()
+
+    # バイト列から作る
+    @staticmethod
+    def from_bytes(data):
+        with np.load(io.BytesIO(data)) as file:
+            header = json.loads(file['header'].tobytes().decode())
+            arrays = {name: file[name] for name in STATE}
+        return BatchSnapshot(header['digest'], arrays, header['generator'], header['rounds'])
+
+
+# 一つのインスタンスの状態の写し
+#
+class BatchInstance:
+
+    # コンストラクタ
+    def __init__(self, batch, index):
+        self.index = index
+        self._variables = VariableView(batch._batch_slots[:, index].tolist())
+        self._array = batch._batch_array[index].tolist()
+
+
+# BatchTinyBasic クラス（同じプログラムの N 個のインスタンスを PC 毎にまとめて実行する）
+# GOSUB と FOR のスタックは深さ depth の固定長で、GOSUB が溢れるとエラーにするが、
+# FOR が溢れると最も古いフレームを捨てる（スカラのインタプリタの FOR のスタックは溢れない）
+#
+class BatchTinyBasic(TinyBasic):
+
+    # コンストラクタ（answer(batch, indices, line, statement, variable) が INPUT の値の並びを返す）
+    def __init__(self, count, answer = None, seed = None, array_size = 1024, depth = 64, patience = 4096):
+
+        # super（ツリーからベクトル化した処理を作るので、バイトコードを持たない transformer として読み込む）
+        super().__init__(backend = 'transformer', seed = seed, array_size = array_size)
+
+        # 入力の初期化
+        self._answer = answer
+
+        # 乱数の初期化（全インスタンスで一つの生成器を使う）
+        self._generator = np.random.default_rng(self._seed)
+
+        # インスタンスの初期化
+        self._count = count
+        self._pcs = np.full(count, -1, np.int32)
+        self._faults = np.zeros(count, bool)
+        self._counts = np.zeros(count, np.int64)
+
+        # 変数と配列の初期化（変数は (26, N)、配列は (N, 大きさ)）
+        self._batch_slots = np.zeros((26, count), np.int16)
+        self._batch_array = np.zeros((count, array_size), np.int16)
+
+        # GOSUB と FOR のスタックの初期化（深さ depth の固定長）
+        self._depth = depth
+        self._gosub_stack = np.zeros((count, depth), np.int32)
+        self._gosub_depth = np.zeros(count, np.int32)
+        self._for_pcs = np.zeros((count, depth), np.int32)
+        self._for_slots = np.zeros((count, depth), np.int32)
+        self._for_limits = np.zeros((count, depth), np.int32)
+        self._for_steps = np.zeros((count, depth), np.int32)
+        self._for_depth = np.zeros(count, np.int32)
+
+        # 実行の初期化（INPUT で待ち合わせ、待たせている間に patience 回ループが回ったら待つのをやめる）
+        self._patience = patience
+        self._handlers = list()
+        self._keys = None
+        self._lookup = None
+        self._faulted = False
+        self._groups = 0
+        self._rounds = 0
+        self._seconds = 0.0
+
+    # Tiny BASIC を実行して結果を返す
+    def run(self, path):
+
+        # 実行
+        super().run(path)
+
+        # 結果
+        return {
+            'instances': self._count,
+            'statements': int(self._counts.sum()),
+            'groups': self._groups,
+            'rounds': self._rounds,
+            'faults': int(self._faults.sum()),
+            'seconds': self._seconds,
+        }
+
+    # インスタンスを停止する
+    def stop(self, indices):
+        self._pcs[indices] = -1
+
+    # インスタンスの状態の写しを取得する
+    def instance(self, index):
+        return BatchInstance(self, index)
+
+    # 全インスタンスの実行状態の写しを作る
+    def snapshot(self):
+        return BatchSnapshot(self._digest, {name: getattr(self, name).copy() for name in STATE}, self._generator.bit_generator.state, self._rounds)
+
+    # 全インスタンスの実行状態を戻す（続きは rounds(restart = False) で実行する）
+    def restore(self, snapshot):
+        if snapshot.digest != self._digest:
+            raise ValueError('the snapshot is for another program.')
+        for name in STATE:
+            if snapshot.arrays[name].shape != getattr(self, name).shape:
+                raise ValueError(f'the snapshot does not fit {name}.')
+        for name in STATE:
+            getattr(self, name)[...] = snapshot.arrays[name]
+        self._generator.bit_generator.state = snapshot.generator
+        self._rounds = snapshot.rounds
+
+    # 実行する
+    def _execute(self):
+        start = time.perf_counter()
+        for active in self.rounds():
+            pass
+        self._seconds = time.perf_counter() - start
+        return True
+
+    # 1 巡毎に実行中のインスタンスの数を返しながら実行する
+    # INPUT 以外で最も小さい PC の組を 1 ステートメントずつ進めるので、先に進んだインスタンスは遅れたものを待って同じ組にまとまる
+    # INPUT に着いたインスタンスは他が全部 INPUT に着くか止まるまで待ち、そこで全部の INPUT にまとめて答えるまでを 1 巡とする
+    def rounds(self, restart = True):
+
+        # 全インスタンスを先頭から
+        if restart:
+            self._pcs[:] = self._targets.get(self._start, -1)
+
+        # 実行の順序（INPUT は最上位のビットを立てて後回しにし、止まったインスタンスの -1 は最後の要素で最大にする）
+        pcs = self._pcs
+        keys = self._keys
+        order = keys[pcs]
+        last = -1
+        loops = 0
+        while True:
+            key = int(order.min())
+
+            # 全部が INPUT で待つか止まったら、INPUT に答えて 1 巡とする（止まらないループがあれば待つのをやめる）
+            if key >= 0x80000000 or loops >= self._patience:
+                self._rounds = self._rounds + 1
+                yield int(np.count_nonzero(pcs >= 0))
+                if key == 0xffffffff:
+                    break
+                self._step_all(order >= 0x80000000)
+                order = keys[pcs]
+                last = -1
+                loops = 0
+                continue
+
+            # 最も小さい PC の組の実行（順序は進めた組の分だけ更新する）
+            if key <= last:
+                loops = loops + 1
+            group = (order == key).nonzero()[0]
+            self._step(key, group)
+            order[group] = keys[pcs[group]]
+            last = key
+
+    # 組を 1 ステートメント進める
+    def _step(self, pc, group):
+        self._faulted = False
+        self._handlers[pc](group)
+        self._counts[group] += 1
+        if self._faulted:
+            self._pcs[group[self._faults[group]]] = -1
+        self._groups = self._groups + 1
+
+    # 指定したインスタンスを PC 毎の組にして 1 ステートメントずつ進める
+    def _step_all(self, mask):
+        pcs = self._pcs
+        active = np.flatnonzero(mask & (pcs >= 0))
+        active = active[np.argsort(pcs[active], kind = 'stable')]
+        for group in np.split(active, np.flatnonzero(np.diff(pcs[active])) + 1):
+            if len(group) > 0:
+                self._step(int(pcs[group[0]]), group)
+
+    # コンパイルする
+    def _compile(self):
+
+        # 行番号から PC への変換表（& 0xffff で引く、無い行は -1）
+        self._lookup = np.full(0x10000, -1, np.int32)
+        for number, pc in self._targets.items():
+            self._lookup[number & 0xffff] = pc
+
+        # 実行の順序の表（INPUT は後回し、最後の要素は止まったインスタンスの -1 で引く）
+        self._keys = np.arange(len(self._statements) + 1, dtype = np.uint32)
+        for pc, tree in enumerate(self._statements):
+            if tree.children[0].data == 'command_input':
+                self._keys[pc] = self._keys[pc] | 0x80000000
+        self._keys[-1] = 0xffffffff
+
+        # ステートメント毎のベクトル化した処理の生成
+        try:
+            self._handlers = [self._compile_vector_statement(tree.children[0], pc) for pc, tree in enumerate(self._statements)]
+
+        # 例外
+        except Exception as e:
+            sys.stderr.write(f'{e}\n')
+            return False
+
+        # 終了
+        return True
+
+    # ステートメントをベクトル化した処理にコンパイルする
+    def _compile_vector_statement(self, tree, pc):
+        pcs = self._pcs
+        slots = self._batch_slots
+        array = self._batch_array
+
+        # LET
+        if tree.data == 'command_let':
+            assignments = list()
+            for let in tree.children:
+                target = let.children[0]
+                value = self._compile_vector(let.children[1])
+                if isinstance(target, Token):
+                    assignments.append((slots[self._slot(target)], None, value))
+                else:
+                    assignments.append((None, self._compile_vector(target.children[0]), value))
+            def handler(idx):
+                for row, index, value in assignments:
+                    if row is not None:
+                        group, result = self._keep(idx, value(idx))
+                        row[group] = result
+                    else:
+                        position = self._index(idx, index(idx))
+                        group, position, result = self._keep(idx, position, value(idx))
+                        array[group, position] = result
+                pcs[idx] = pc + 1
+            return handler
+
+        # INPUT
+        elif tree.data == 'command_input':
+            prompt = tree.children[0].children
+            variable = prompt[len(prompt) - 1].value.upper()
+            slot = self._slot(prompt[len(prompt) - 1])
+            line, statement = self._positions[pc]
+            def handler(idx):
+                if self._answer is None:
+                    pcs[idx] = -1
+                    return
+                values = np.asarray(self._answer(self, idx, line, statement, variable), np.int64)
+                waiting = pcs[idx] == pc
+                slots[slot, idx[waiting]] = values[waiting].astype(np.int16)
+                pcs[idx[waiting]] = pc + 1
+            return handler
+
+        # IF
+        elif tree.data == 'command_if':
+            condition = self._compile_vector(tree.children[0])
+            otherwise = self._elses[pc]
+            def handler(idx):
+                pcs[idx] = np.where(condition(idx) != 0, pc + 1, otherwise)
+            return handler
+
+        # GOTO
+        elif tree.data == 'command_goto':
+            target = self._compile_vector(tree.children[0])
+            def handler(idx):
+                pcs[idx] = self._jump(idx, target(idx))
+            return handler
+
+        # GOSUB
+        elif tree.data == 'command_gosub':
+            target = self._compile_vector(tree.children[0])
+            def handler(idx):
+                destination = self._jump(idx, target(idx))
+                depth = self._gosub_depth[idx]
+                overflow = depth >= self._depth
+                if overflow.any():
+                    self._fault(idx[overflow])
+                    depth = np.minimum(depth, self._depth - 1)
+                self._gosub_stack[idx, depth] = pc + 1
+                self._gosub_depth[idx] = depth + 1
+                pcs[idx] = destination
+            return handler
+
+        # RETURN
+        elif tree.data == 'command_return':
+            def handler(idx):
+                depth = self._gosub_depth[idx] - 1
+                empty = depth < 0
+                if empty.any():
+                    self._fault(idx[empty])
+                    depth = np.maximum(depth, 0)
+                pcs[idx] = self._gosub_stack[idx, depth]
+                self._gosub_depth[idx] = depth
+            return handler
+
+        # FOR
+        elif tree.data == 'command_for':
+            slot = self._slot(tree.children[0])
+            row = slots[slot]
+            first = self._compile_vector(tree.children[1])
+            last = self._compile_vector(tree.children[2])
+            step = self._compile_vector(tree.children[3]) if len(tree.children) >= 4 else None
+            def handler(idx):
+                value = first(idx)
+                limit = last(idx)
+                increment = step(idx) if step is not None else 1
+                group, value, limit, increment = self._keep(idx, value, limit, increment)
+                row[group] = value
+                self._push_for(group, pc + 1, slot, limit, increment)
+                pcs[group] = pc + 1
+            return handler
+
+        # NEXT
+        elif tree.data == 'command_next':
+            slot = self._slot(tree.children[0])
+            body = self._bind_next(pc)
+            def handler(idx):
+                self._next(idx, pc, slot, body)
+            return handler
+
+        # STOP
+        elif tree.data == 'command_stop':
+            def handler(idx):
+                pcs[idx] = -1
+            return handler
+
+        # PRINT（出力は捨てるが、エラーと乱数を揃えるため式は評価する）
+        expressions = [self._compile_vector(element) for element in tree.children if isinstance(element, Tree)]
+        def handler(idx):
+            group = idx
+            for expression in expressions:
+                group = self._keep(group)[0]
+                expression(group)
+            pcs[idx] = pc + 1
+        return handler
+
+    # 式をベクトル化した関数にコンパイルする
+    def _compile_vector(self, tree):
+        slots = self._batch_slots
+
+        # トークン
+        if isinstance(tree, Token):
+            if tree.type == 'NUMBER':
+                values = np.full(self._count, self._int16(tree.value), np.int16)
+                values.flags.writeable = False
+                return lambda idx: values[:len(idx)]
+            elif tree.type == 'VARIABLE':
+                row = slots[self._slot(tree)]
+                return lambda idx: row[idx]
+
+        # 二項演算
+        elif tree.data in BINARIES:
+            left = self._compile_vector(tree.children[0])
+            right = self._compile_vector(tree.children[1])
+            operator = BINARIES[tree.data]
+            return lambda idx: operator(left(idx), right(idx))
+
+        # 割り算（0 で割ったインスタンスはエラーで止める）
+        elif tree.data == 'division':
+            left = self._compile_vector(tree.children[0])
+            right = self._compile_vector(tree.children[1])
+            def division(idx):
+                dividend = left(idx).astype(np.int32)
+                divisor = right(idx).astype(np.int32)
+                zero = divisor == 0
+                if zero.any():
+                    self._fault(idx[zero])
+                    divisor = np.where(zero, 1, divisor)
+                quotient = np.abs(dividend) // np.abs(divisor)
+                return np.where((dividend < 0) != (divisor < 0), -quotient, quotient).astype(np.int16)
+            return division
+
+        # 単項マイナス
+        elif tree.data == 'negative':
+            operand = self._compile_vector(tree.children[0])
+            return lambda idx: -operand(idx)
+
+        # 配列
+        elif tree.data == 'array':
+            operand = self._compile_vector(tree.children[0])
+            array = self._batch_array
+            return lambda idx: array[idx, self._index(idx, operand(idx))]
+
+        # ABS
+        elif tree.data == 'function_abs':
+            operand = self._compile_vector(tree.children[0])
+            return lambda idx: np.abs(operand(idx))
+
+        # RND（1 未満はエラー）
+        elif tree.data == 'function_rnd':
+            operand = self._compile_vector(tree.children[0])
+            def rnd(idx):
+                limit = operand(idx)
+                invalid = limit < 1
+                if invalid.any():
+                    self._fault(idx[invalid])
+                    limit = np.where(invalid, 1, limit)
+                return self._draw(idx, limit)
+            return rnd
+
+        # expression, sum, product, atom, positive, factor
+        return self._compile_vector(tree.children[0])
+
+    # 1 以上 limit 以下の乱数をインスタンス毎に引く
+    def _draw(self, idx, limit):
+        return self._generator.integers(1, limit.astype(np.int64) + 1).astype(np.int16)
+
+    # インスタンスをエラーで止める印を付ける
+    def _fault(self, indices):
+        self._faults[indices] = True
+        self._faulted = True
+
+    # エラーの無いインスタンスとその値に絞る
+    def _keep(self, idx, *values):
+        if not self._faulted:
+            return (idx,) + values
+        mask = ~self._faults[idx]
+        return (idx[mask],) + tuple(value[mask] if isinstance(value, np.ndarray) else value for value in values)
+
+    # 配列の添字を範囲内にする（範囲外はエラー）
+    def _index(self, idx, value):
+        position = value.astype(np.uint16)
+        outside = position >= self._batch_array.shape[1]
+        if outside.any():
+            self._fault(idx[outside])
+            position = np.where(outside, 0, position)
+        return position
+
+    # 行番号を PC にする（無い行はエラー）
+    def _jump(self, idx, value):
+        destination = self._lookup[value.astype(np.uint16)]
+        missing = destination < 0
+        if missing.any():
+            self._fault(idx[missing])
+        return destination
+
+    # FOR のフレームを積む（溢れたら最も古いフレームを捨てる）
+    def _push_for(self, idx, body, slot, limit, step):
+        depth = self._for_depth[idx]
+        full = depth >= self._depth
+        if full.any():
+            for frames in (self._for_pcs, self._for_slots, self._for_limits, self._for_steps):
+                frames[idx[full], :-1] = frames[idx[full], 1:]
+            depth = np.minimum(depth, self._depth - 1)
+        self._for_pcs[idx, depth] = body
+        self._for_slots[idx, depth] = slot
+        self._for_limits[idx, depth] = limit
+        self._for_steps[idx, depth] = step
+        self._for_depth[idx] = depth + 1
+
+    # NEXT を実行する
+    def _next(self, idx, pc, slot, body):
+        pcs = self._pcs
+        slots = self._batch_slots
+
+        # 全部の先頭のフレームが対応する FOR ならそのまま進める
+        top = self._for_depth[idx] - 1
+        if top.min() >= 0 and (self._for_pcs[idx, top] == body).all():
+            step = self._for_steps[idx, top]
+            limit = self._for_limits[idx, top]
+            row = slots[slot]
+            value = row[idx] + step.astype(np.int16)
+            row[idx] = value
+            pcs[idx] = np.where(np.where(step > 0, value <= limit, (step < 0) & (value >= limit)), body, pc + 1)
+            return
+
+        # 先頭のフレームが対応する FOR でなければ同じ変数のフレームまで捨てる
+        while True:
+            other = (top >= 0) & (self._for_slots[idx, np.maximum(top, 0)] != slot)
+            if not other.any():
+                break
+            top = top - other
+        self._for_depth[idx] = top + 1
+
+        # ループ変数を進めて続けるかを決める（フレームが無ければ次へ）
+        found = top >= 0
+        top = np.maximum(top, 0)
+        step = self._for_steps[idx, top]
+        limit = self._for_limits[idx, top]
+        value = slots[slot, idx] + step.astype(np.int16)
+        slots[slot, idx[found]] = value[found]
+        repeat = found & np.where(step > 0, value <= limit, (step < 0) & (value >= limit))
+        pcs[idx] = np.where(repeat, self._for_pcs[idx, top], pc + 1)
+
+
+# アプリケーションのエントリポイント
+#
+if __name__ == '__main__':
+
+    # 引数の取得
+    parser = argparse.ArgumentParser(description = 'Lockstep batch Tiny BASIC')
+    parser.add_argument('path', help = 'BASIC program')
+    parser.add_argument('--count', type = int, default = 1000, help = 'number of instances')
+    parser.add_argument('--seed', type = int, default = None, help = 'seed for RND')
+    parser.add_argument('--array-size', type = int, default = 1024, help = 'number of @() elements')
+    args = parser.parse_args()
+
+    # Tiny BASIC の実行（INPUT に着いたインスタンスは終了する）
+    result = BatchTinyBasic(args.count, seed = args.seed, array_size = args.array_size).run(args.path)
+
+    # 結果の出力
+    rate = result['statements'] / result['seconds'] if result['seconds'] > 0 else 0
+    sys.stderr.write(f"instances: {result['instances']}, statements: {result['statements']}, groups: {result['groups']}, seconds: {result['seconds']:.3f}, statements/sec: {rate:.0f}\n")
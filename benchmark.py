@@ -0,0 +1,205 @@
+# benchmark.py - Tiny BASIC ベンチマーク
+#
+
+
+# 参照
+#
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from tinybasic import TinyBasic
+from tinybasic import BACKENDS
+from tinybasic import VERSION
+from tinybasic import InputReplayer
+from headless import HeadlessTinyBasic
+
+
+# ステートメント毎のマイクロベンチマーク
+#
+MICROS = {
+    'let': '10 F.I=1TO20000;A=B+1,C=A*2-B,D=(C+A)/3;N.I',
+    'print': '10 F.I=1TO20000;PR.#4,I," ",;N.I',
+    'if': '10 F.I=1TO20000;IFI>5A=1\n20 N.I',
+    'goto': '10 I=0\n20 I=I+1;IFI<20000G.20',
+    'gosub': '10 F.I=1TO20000;GOS.100;N.I;STOP\n100 R.',
+    'for': '10 F.I=1TO100;F.J=1TO200;N.J;N.I',
+    'array': '10 F.I=1TO20000;@(I/20)=@(I/20+1)+I;N.I',
+    'rnd': '10 F.I=1TO20000;A=R.(99);N.I',
+}
+
+
+# 一時ディレクトリに BASIC のプログラムを書く
+#
+def write_program(directory, name, source):
+    path = os.path.join(directory, name + '.bas')
+    with open(path, 'w', encoding='UTF-8') as file:
+        file.write(source + '\n')
+    return path
+
+
+# ヘッドレスで一度実行する
+#
+def run_once(path, backend, session):
+    if session is None:
+        return HeadlessTinyBasic([], backend = backend, seed = 0).run(path)
+    return HeadlessTinyBasic([], backend = backend, replayer = InputReplayer(session)).run(path)
+
+
+# 最良の実行結果を求める
+#
+def run_best(path, backend, session, repeat):
+    best = None
+    for i in range(repeat):
+        result = run_once(path, backend, session)
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    best['rate'] = best['statements'] / best['seconds'] if best['seconds'] > 0 else 0
+    return best
+
+
+# マイクロベンチマークを行う
+#
+def bench_micro(directory, backend, repeat):
+    results = dict()
+    for name, source in MICROS.items():
+        path = write_program(directory, name, source)
+        results[name] = run_best(path, backend, None, repeat)
+    return results
+
+
+# 読み込みと解析の時間を計測する
+#
+def bench_startup(path, backend, repeat):
+
+    # 各段階の最良の時間（ms）
+    results = dict()
+    def measure(phase, function):
+        start = time.perf_counter()
+        function()
+        elapsed = (time.perf_counter() - start) * 1000
+        if phase not in results or elapsed < results[phase]:
+            results[phase] = elapsed
+
+    # 計測（lark は毎回新しいキャッシュファイルで表を作る時間と、そのファイルから読む時間を測る）
+    directory = os.path.dirname(path)
+    lark_cache = TinyBasic._lark_cache
+    try:
+        for i in range(repeat):
+            TinyBasic._lark = None
+            TinyBasic._lark_cache = os.path.join(directory, f'lark-{backend}-{i}.cache')
+            basic = TinyBasic(backend = backend)
+            basic._path = path
+            measure('lark', basic._get_lark)
+            TinyBasic._lark = None
+            measure('lark-disk', basic._get_lark)
+            measure('load', basic._load)
+            measure('parse', basic._parse)
+            measure('compile', basic._compile)
+            basic._load_cache()
+            basic._save_cache()
+            cached = TinyBasic(backend = backend)
+            cached._path = path
+            measure('cache', lambda: cached._load_cache() and cached._compile())
+
+    # パーサのキャッシュを元に戻す
+    finally:
+        TinyBasic._lark_cache = lark_cache
+    return results
+
+
+# 記録したセッションのプログラムを探す（記録されているのはファイル名だけ）
+#
+def find_program(name, session):
+    for directory in ('', os.path.dirname(os.path.abspath(session)), os.path.dirname(os.path.abspath(__file__))):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    raise SystemExit(f'{name} recorded in {session} was not found, give it with --program.')
+
+
+# 記録したセッションを再生する
+#
+def bench_replay(path, session, backend, repeat):
+    return run_best(path, backend, session, repeat)
+
+
+# 結果を表示する
+#
+def report(results, baseline):
+
+    # 以前の結果との比
+    def ratio(value, *keys):
+        try:
+            previous = baseline['backends']
+            for key in keys:
+                previous = previous[key]
+            return f' ({value / previous:.2f}x)'
+        except (KeyError, TypeError, ZeroDivisionError):
+            return ''
+
+    # バックエンド毎の表示
+    for backend, result in results.items():
+        print(f'[{backend}]')
+        for name, micro in result['micro'].items():
+            print(f"  micro   {name:9s} {micro['rate']:12.0f} statements/sec{ratio(micro['rate'], backend, 'micro', name, 'rate')}")
+        for phase, ms in result['startup'].items():
+            print(f'  startup {phase:9s} {ms:12.2f} ms')
+        replay = result['replay']
+        print(f"  replay   {replay['statements']} statements in {replay['seconds'] * 1000:.1f} ms, {replay['rate']:.0f} statements/sec{ratio(replay['rate'], backend, 'replay', 'rate')}")
+
+
+# アプリケーションのエントリポイント
+#
+if __name__ == '__main__':
+
+    # 引数の取得
+    parser = argparse.ArgumentParser(description = 'Tiny BASIC benchmark')
+    parser.add_argument('--backend', action = 'append', choices = BACKENDS, help = 'backend to measure (repeatable, default: all)')
+    parser.add_argument('--session', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions', 'tinytrek.json'), help = 'recorded session to replay')
+    parser.add_argument('--program', default = None, help = 'BASIC program the session was recorded with (default: the recorded name, looked up in the current directory, next to the session and next to this script)')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'runs per measurement, the best one is kept')
+    parser.add_argument('--json', default = None, help = 'write the results to this JSON file')
+    parser.add_argument('--compare', default = None, help = 'JSON file from an earlier run to compare statements/sec against')
+    args = parser.parse_args()
+
+    # セッションの読み込み
+    with open(args.session, 'r', encoding='UTF-8') as file:
+        session = json.load(file)
+    program = args.program if args.program is not None else find_program(session['program'], args.session)
+
+    # 比較対象の読み込み
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r', encoding='UTF-8') as file:
+            baseline = json.load(file)
+
+    # ベンチマークの実行
+    results = dict()
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, os.path.basename(program))
+        shutil.copyfile(program, path)
+        for backend in args.backend or BACKENDS:
+            results[backend] = {
+                'micro': bench_micro(directory, backend, args.repeat),
+                'startup': bench_startup(path, backend, args.repeat),
+                'replay': bench_replay(path, args.session, backend, args.repeat),
+            }
+    finally:
+        shutil.rmtree(directory)
+
+    # 結果の表示
+    report(results, baseline)
+
+    # 結果の保存
+    if args.json is not None:
+        with open(args.json, 'w', encoding='UTF-8') as file:
+            json.dump({
+                'version': VERSION,
+                'python': platform.python_version(),
+                'backends': results,
+            }, file, indent = 4)
@@ -0,0 +1,107 @@
+# headless.py - Headless Tiny BASIC
+#
+
+
+# 参照
+#
+import sys
+import time
+import argparse
+from tinybasic import TinyBasic
+from tinybasic import BACKENDS
+from tinybasic import Profiler
+from tinybasic import InputRecorder
+from tinybasic import InputReplayer
+from tinybasic import BufferedOutput
+from tinybasic import NullOutput
+
+
+# HeadlessTinyBasic クラス
+#
+class HeadlessTinyBasic(TinyBasic):
+
+    # コンストラクタ
+    def __init__(self, inputs, output = None, **options):
+
+        # super（出力は write を持つもの、無ければ捨てる）
+        super().__init__(output = output if output is not None else NullOutput(), **options)
+
+        # 入力の初期化（文字列を返す反復可能なもの）
+        self._inputs = iter(inputs)
+        self._consumed = 0
+
+        # 計測の初期化
+        self._seconds = 0.0
+
+    # Tiny BASIC を実行して結果を返す
+    def run(self, path):
+
+        # 実行
+        super().run(path)
+
+        # 結果
+        return {
+            'statements': self._executed,
+            'seconds': self._seconds,
+            'inputs': self._consumed,
+        }
+
+    # 実行する
+    def _execute(self):
+
+        # 実行時間の計測
+        start = time.perf_counter()
+        try:
+            result = super()._execute()
+        finally:
+            self._seconds = time.perf_counter() - start
+
+        # 終了
+        return result
+
+    # 1 行を入力する
+    def _readline(self):
+        try:
+            string = next(self._inputs)
+        except StopIteration:
+            return None
+        self._consumed = self._consumed + 1
+        return string.rstrip('\r\n')
+
+
+# アプリケーションのエントリポイント
+#
+if __name__ == '__main__':
+
+    # 引数の取得
+    parser = argparse.ArgumentParser(description = 'Headless Tiny BASIC')
+    parser.add_argument('path', help = 'BASIC program')
+    parser.add_argument('--input', default = None, help = 'file with one INPUT reply per line (default: stdin)')
+    parser.add_argument('--output', action = 'store_true', help = 'write program output to stdout')
+    parser.add_argument('--backend', default = 'bytecode', choices = BACKENDS)
+    parser.add_argument('--seed', type = int, default = None, help = 'seed for RND')
+    parser.add_argument('--record', default = None, help = 'record the INPUT values and the seed to a JSON file')
+    parser.add_argument('--replay', default = None, help = 'feed the INPUT values recorded with --record back')
+    parser.add_argument('--profile', default = None, help = "print per-line counts and times to stderr and write them as JSON to a file, or only print with '-'")
+    args = parser.parse_args()
+
+    # 入力と出力
+    inputs = open(args.input, 'r', encoding='UTF-8') if args.input is not None else sys.stdin
+    output = BufferedOutput() if args.output else None
+
+    # プロファイラ
+    profiler = None
+    if args.profile is not None:
+        profiler = Profiler(None if args.profile == '-' else args.profile)
+
+    # INPUT の記録と再生
+    recorder = InputRecorder(args.record) if args.record is not None else None
+    replayer = InputReplayer(args.replay) if args.replay is not None else None
+
+    # Tiny BASIC の実行
+    with inputs:
+        result = HeadlessTinyBasic(inputs, output, backend = args.backend, profiler = profiler, seed = args.seed, recorder = recorder, replayer = replayer).run(args.path)
+
+    # 結果の出力
+    rate = result['statements'] / result['seconds'] if result['seconds'] > 0 else 0
+    sys.stderr.write(f"statements: {result['statements']}, inputs: {result['inputs']}, seconds: {result['seconds']:.3f}, statements/sec: {rate:.0f}\n")
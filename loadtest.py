@@ -0,0 +1,105 @@
+# loadtest.py - Tiny BASIC サーバの負荷試験
+#
+
+
+# 参照
+#
+import os
+import json
+import time
+import asyncio
+import argparse
+from server import GO_AHEAD
+
+
+# プロンプト（サーバは INPUT で待つときに GO_AHEAD を送る）を受け取るまで読む（接続が閉じられたら None）
+#
+async def read_prompt(reader):
+    try:
+        return await reader.readuntil(GO_AHEAD)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+# 記録した INPUT の値を答える 1 つのセッション（プロンプト毎の待ち時間を返す）
+#
+async def run_session(host, port, values, timeout):
+    latencies = []
+    reader, writer = await asyncio.open_connection(host, port, limit = 1 << 20)
+    try:
+        start = time.perf_counter()
+        for value in values + [None]:
+            prompt = await asyncio.wait_for(read_prompt(reader), timeout)
+            if prompt is None:
+                break
+            latencies.append(time.perf_counter() - start)
+            if value is None:
+                break
+            start = time.perf_counter()
+            writer.write(f'{value}\r\n'.encode('ascii'))
+            await writer.drain()
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+    return latencies
+
+
+# 複数のセッションを同時に行う
+#
+async def run(host, port, sessions, values, timeout):
+    tasks = [run_session(host, port, values, timeout) for i in range(sessions)]
+    return await asyncio.gather(*tasks, return_exceptions = True)
+
+
+# 分位点（ms）を求める
+#
+def percentile(values, rate):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * rate))] * 1000
+
+
+# アプリケーションのエントリポイント
+#
+if __name__ == '__main__':
+
+    # 引数の取得
+    parser = argparse.ArgumentParser(description = 'Tiny BASIC server load test')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 2323)
+    parser.add_argument('--sessions', type = int, default = 200, help = 'concurrent sessions')
+    parser.add_argument('--session', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions', 'tinytrek.json'), help = 'recorded session whose INPUT values every session sends (start the server with its --seed to replay it exactly)')
+    parser.add_argument('--limit', type = int, default = None, help = 'prompts answered per session (default: all recorded values)')
+    parser.add_argument('--timeout', type = float, default = 30.0, help = 'seconds to wait for a prompt')
+    args = parser.parse_args()
+
+    # 記録の読み込み
+    with open(args.session, 'r', encoding='UTF-8') as file:
+        values = [record['value'] for record in json.load(file)['inputs']][:args.limit]
+
+    # 負荷試験
+    start = time.perf_counter()
+    results = asyncio.run(run(args.host, args.port, args.sessions, values, args.timeout))
+    seconds = time.perf_counter() - start
+
+    # 結果の集計
+    latencies = sorted(latency for result in results if isinstance(result, list) for latency in result)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    print(json.dumps({
+        'sessions': args.sessions,
+        'errors': len(errors),
+        'prompts': len(latencies),
+        'seconds': seconds,
+        'prompts/sec': len(latencies) / seconds if seconds > 0 else 0,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': percentile(latencies, 1.0),
+        },
+    }, indent = 4))
+    for error in errors[:5]:
+        print(f'{type(error).__name__}: {error}')
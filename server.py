@@ -0,0 +1,136 @@
+# server.py - Tiny BASIC のマルチセッションサーバ
+#
+
+
+# 参照
+#
+import sys
+import random
+import asyncio
+import argparse
+from tinybasic import TinyBasic
+from tinybasic import BACKENDS
+from tinybasic import BufferedOutput
+
+
+# プロンプトの終わりの印（telnet の IAC GA、出力は ASCII なので本文には現れない）
+#
+GO_AHEAD = b'\xff\xf9'
+
+
+# 接続に書き込むファイル（改行を CR LF にして StreamWriter の送信バッファに積む）
+#
+class StreamFile:
+
+    # コンストラクタ
+    def __init__(self, writer):
+        self._writer = writer
+
+    # 文字列を書き込む
+    def write(self, string):
+        self._writer.write(string.replace('\n', '\r\n').encode('ascii', 'replace'))
+
+    # フラッシュする（送信は drain で待つ）
+    def flush(self):
+        pass
+
+
+# 1 つのプログラムを複数の接続で実行するサーバ
+#
+class TinyBasicServer:
+
+    # コンストラクタ（quota は 1 回の順番で実行するステートメント数、seed は全セッションで使う種）
+    def __init__(self, prototype, quota = 1000, seed = None):
+
+        # 解析済みのプログラム（セッション毎に fork する）
+        self._prototype = prototype
+        self._quota = quota
+        self._seed = seed
+
+        # 計測
+        self.sessions = 0
+        self.active = 0
+
+    # 接続を待ち受ける
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self._session, host, port)
+        for socket in server.sockets:
+            sys.stderr.write(f'listening on {socket.getsockname()}\n')
+        async with server:
+            await server.serve_forever()
+
+    # 1 つの接続でプログラムを実行する
+    async def _session(self, reader, writer):
+
+        # セッションの初期化（変数、配列、乱数は接続毎）
+        basic = self._prototype.fork()
+        basic._seed = self._seed if self._seed is not None else random.randrange(1 << 32)
+        basic._random.seed(basic._seed)
+        basic._output = BufferedOutput(StreamFile(writer), limit = None)
+        self.sessions = self.sessions + 1
+        self.active = self.active + 1
+
+        # 実行（quota 毎に他のセッションに順番を譲り、INPUT では出力と GO_AHEAD を送って 1 行を待つ）
+        machine = basic.interpret(basic._targets.get(basic._start, -1), self._quota)
+        value = None
+        try:
+            while True:
+                pc, key = machine.send(value)
+                value = None
+                if key is None:
+                    await asyncio.sleep(0)
+                else:
+                    basic._output.flush()
+                    writer.write(GO_AHEAD)
+                    await writer.drain()
+                    try:
+                        line = await reader.readline()
+                    except ValueError:
+                        break
+                    if not line:
+                        break
+                    value = basic._parse_input(line.decode('ascii', 'replace').strip())
+                    if value is None:
+                        basic._newline()
+        except StopIteration:
+            pass
+        except ConnectionError:
+            pass
+
+        # 終了
+        finally:
+            self.active = self.active - 1
+            try:
+                basic._output.flush()
+                await writer.drain()
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+# アプリケーションのエントリポイント
+#
+if __name__ == '__main__':
+
+    # 引数の取得
+    parser = argparse.ArgumentParser(description = 'Tiny BASIC multi-session server')
+    parser.add_argument('path', nargs = '?', default = 'tinytrek.bas', help = 'BASIC program')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 2323)
+    parser.add_argument('--backend', default = 'bytecode', choices = BACKENDS)
+    parser.add_argument('--quota', type = int, default = 1000, help = 'statements a session runs before yielding to the others')
+    parser.add_argument('--seed', type = int, default = None, help = 'seed for RND in every session (default: random per session)')
+    args = parser.parse_args()
+
+    # プログラムの準備
+    prototype = TinyBasic(backend = args.backend)
+    if not prototype.prepare(args.path):
+        sys.exit(1)
+
+    # サーバの実行
+    server = TinyBasicServer(prototype, quota = args.quota, seed = args.seed)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,463 @@
+# simulator.py - TinyTrek のモンテカルロシミュレータ
+#
+
+
+# 参照
+#
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import importlib
+from abc import ABC
+from abc import abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+from tinybasic import TinyBasic
+from tinybasic import BACKENDS
+from headless import HeadlessTinyBasic
+
+
+# 艦長（INPUT に答える方針）の基底クラス
+#
+class Captain(ABC):
+
+    # コンストラクタ
+    def __init__(self, seed):
+        self._random = random.Random(seed)
+        self._command = None
+
+    # INPUT に答える（答えられなければ None）
+    def answer(self, game, line, variable):
+        if line == 5:
+            return self._letter(game, 'Y' if self.difficult(game) else 'N')
+        elif line == 120:
+            self._command = self.command(game)
+            return self._letter(game, self._command)
+        elif line == 265:
+            return self.units(game)
+        elif line == 470:
+            return self.distance(game)
+        elif line == 615:
+            return self.course(game)
+        return None
+
+    # 難しいゲームにするかを選ぶ
+    def difficult(self, game):
+        return False
+
+    # コマンドを選ぶ（'S', 'G', 'L', 'P', 'R', 'W', 'T'）
+    @abstractmethod
+    def command(self, game):
+        pass
+
+    # フェイザーのエネルギーを選ぶ
+    @abstractmethod
+    def units(self, game):
+        pass
+
+    # ワープの距離を選ぶ
+    @abstractmethod
+    def distance(self, game):
+        pass
+
+    # ワープまたは魚雷の針路を選ぶ
+    @abstractmethod
+    def course(self, game):
+        pass
+
+    # 文字の入力を変数の値にする
+    def _letter(self, game, letter):
+        return game._variables[letter]
+
+
+# 無作為に答える艦長
+#
+class RandomCaptain(Captain):
+
+    # コマンドを選ぶ
+    def command(self, game):
+        return self._random.choice('SGLPRWT')
+
+    # フェイザーのエネルギーを選ぶ
+    def units(self, game):
+        return self._random.randint(1, max(1, game._variables['E']))
+
+    # ワープの距離を選ぶ
+    def distance(self, game):
+        return self._random.randint(1, 16)
+
+    # ワープまたは魚雷の針路を選ぶ
+    def course(self, game):
+        return self._random.randint(0, 359)
+
+
+# クリンゴンを探して戦う艦長（銀河の状態はすべて見えているものとする）
+#
+class HunterCaptain(Captain):
+
+    # コマンドを選ぶ
+    def command(self, game):
+        variables = game._variables
+
+        # クリンゴンがいれば戦う
+        if variables['N'] > 0:
+            if self._damage(game, 4) == 0 and variables['E'] > 600:
+                return 'P'
+            if self._damage(game, 6) == 0 and variables['F'] > 0:
+                return 'T'
+
+        # いなければ移動する
+        return 'W'
+
+    # フェイザーのエネルギーを選ぶ（全滅させられる量、過負荷と予備の 300 は超えない）
+    def units(self, game):
+        variables = game._variables
+        need = 0
+        for sector, energy in self._klingons(game):
+            distance = (sector[0] - variables['X']) ** 2 + (sector[1] - variables['Y']) ** 2
+            need = max(need, energy * (30 + distance) // 30 + 1)
+        return max(1, min(min(need, 1090) * variables['N'], variables['E'] - 300))
+
+    # ワープの距離を選ぶ
+    def distance(self, game):
+        variables = game._variables
+        row, column = self._target(game)
+        distance = max(abs(row), abs(column))
+        if self._damage(game, 5) > 0:
+            distance = min(distance, 2)
+        while distance > 1 and variables['E'] < distance * distance // 2:
+            distance = distance - 1
+        return max(1, min(distance, 91))
+
+    # ワープまたは魚雷の針路を選ぶ
+    def course(self, game):
+        variables = game._variables
+        if self._command == 'T':
+            klingons = self._klingons(game)
+            if len(klingons) > 0:
+                (row, column), energy = min(klingons, key = lambda klingon: (klingon[0][0] - variables['X']) ** 2 + (klingon[0][1] - variables['Y']) ** 2)
+                return self._bearing(row - variables['X'], column - variables['Y'])
+        return self._bearing(*self._target(game))
+
+    # 装置の損傷を取得する（1: 短距離センサ ... 7: シールド）
+    def _damage(self, game, device):
+        return game._array[device + 63]
+
+    # 象限内のクリンゴンの位置とエネルギーを取得する
+    def _klingons(self, game):
+        array = game._array
+        return [((array[m + 6], array[m + 12]), array[m]) for m in range(135, 141) if array[m] > 0]
+
+    # 移動先への相対位置を求める（エネルギーが少なければ基地、それ以外はクリンゴン）
+    def _target(self, game):
+        variables = game._variables
+        array = game._array
+        u, v, x, y = variables['U'], variables['V'], variables['X'], variables['Y']
+
+        # 象限内の基地に横付けする
+        if variables['E'] < 1000 and variables['O'] == 0:
+            for i in range(1, 9):
+                for j in range(1, 9):
+                    if array[8 * i + j + 62] == 2:
+                        return i - x, j - y
+
+        # 最寄りの象限の中央に向かう
+        best = None
+        for q in range(64):
+            value = abs(array[q])
+            wanted = value // 10 % 10 if variables['E'] < 1000 else value // 100
+            if wanted > 0 and q != 8 * u + v - 9:
+                row = (q // 8) * 8 + 4 - ((u - 1) * 8 + x - 1)
+                column = (q % 8) * 8 + 4 - ((v - 1) * 8 + y - 1)
+                if best is None or max(abs(row), abs(column)) < max(abs(best[0]), abs(best[1])):
+                    best = (row, column)
+        if best is None:
+            best = (self._random.randint(-8, 8), self._random.randint(-8, 8))
+        return best
+
+    # 相対位置から針路を求める（0 が北、時計回り、90 度毎の区間内は線形）
+    def _bearing(self, row, column):
+        if row == 0 and column == 0:
+            return 0
+        if abs(row) >= abs(column):
+            if row < 0:
+                course = 45 * column / -row
+            else:
+                course = 180 - 45 * column / row
+        else:
+            if column > 0:
+                course = 90 + 45 * row / column
+            else:
+                course = 270 + 45 * row / column
+        return round(course) % 360
+
+
+# 艦長の一覧
+#
+CAPTAINS = {
+    'random': RandomCaptain,
+    'hunter': HunterCaptain,
+}
+
+
+# 艦長が INPUT に答える TinyTrek
+#
+class SimulatedTinyTrek(HeadlessTinyBasic):
+
+    # コンストラクタ
+    def __init__(self, max_turns = 2000, **options):
+
+        # super
+        super().__init__([], **options)
+
+        # 艦長の初期化（ゲーム毎に play で渡す）
+        self._captain = None
+        self._max_turns = max_turns
+        self._turns = 0
+
+        # 結果の初期化
+        self._outcome = None
+
+    # 読み込んだプログラムを fork して 1 ゲームを行う（自身の状態は変えない）
+    def play(self, captain, seed):
+
+        # ゲームの準備
+        game = self.fork()
+        game._captain = captain
+        game._seed = seed
+        game._random.seed(seed)
+
+        # 実行
+        game._execute()
+
+        # 結果（110 行に着かなければ打ち切りかエラー）
+        result = game._outcome
+        if result is None:
+            result = score(game._variables)
+            result['outcome'] = 'timeout' if game._turns > game._max_turns else 'error'
+            result['score'] = 0
+        result.update({
+            'seed': game._seed,
+            'turns': game._turns,
+            'statements': game._executed,
+            'seconds': game._seconds,
+        })
+        return result
+
+    # INPUT に艦長が答える
+    def _replay(self, pc, key):
+
+        # 手数の上限
+        self._turns = self._turns + 1
+        if self._turns > self._max_turns:
+            return None
+
+        # ゲームの終了（110 行の「もう一度？」で結果を取る）
+        line, statement = self._positions[pc]
+        if line == 110:
+            self._outcome = score(self._variables)
+            return None
+
+        # 艦長の答え
+        return self._captain.answer(self, line, key)
+
+
+# 終了時の変数から結果を求める
+#
+def score(variables):
+    if variables['K'] == 0:
+        outcome = 'accomplished'
+        points = variables['I'] + variables['J']
+        stardates = variables['D']
+    else:
+        outcome = 'late' if variables['D'] < 0 else 'destroyed'
+        points = 0
+        stardates = 30 - variables['D']
+    return {
+        'outcome': outcome,
+        'score': points,
+        'stardates': stardates,
+        'casualties': variables['C'],
+        'klingons': variables['H'] - variables['K'],
+    }
+
+
+# 読み込んだプログラム（ワーカ毎に一つ、ゲーム毎に fork する）
+#
+_prototype = None
+
+
+# プログラムを解析してキャッシュする
+#
+def prepare(path, backend):
+    return load(TinyBasic(backend = backend), path)
+
+
+# プログラムを読み込んでコンパイルする
+#
+def load(basic, path):
+    if not basic.prepare(path):
+        raise ValueError(f'{path} could not be loaded.')
+    return basic
+
+
+# ワーカを初期化する
+#
+def _initialize(path, backend, max_turns):
+    global _prototype
+    _prototype = load(SimulatedTinyTrek(max_turns, backend = backend), path)
+
+
+# 1 ゲームを行う
+#
+def _play(index, seed, captain):
+    result = _prototype.play(captain(seed), seed)
+    result['game'] = index
+    return result
+
+
+# ゲームを並列に行い、終わった順に結果を返す
+#
+def simulate(path, games, captain = HunterCaptain, jobs = None, seed = 0, backend = 'bytecode', max_turns = 2000):
+
+    # 1 プロセスで実行
+    if jobs == 1:
+        _initialize(path, backend, max_turns)
+        for index in range(games):
+            yield _play(index, seed + index, captain)
+        return
+
+    # キャッシュを作ってからワーカを起動
+    prepare(path, backend)
+    with ProcessPoolExecutor(max_workers = jobs, initializer = _initialize, initargs = (path, backend, max_turns)) as executor:
+        futures = [executor.submit(_play, index, seed + index, captain) for index in range(games)]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+# ゲームを NumPy で一括して同時に行い、終わった順に結果を返す
+#
+def simulate_batch(path, games, captain = HunterCaptain, seed = 0, max_turns = 2000):
+
+    # NumPy は一括実行でだけ使う
+    import numpy as np
+    from batch import BatchTinyBasic
+
+    # 艦長と結果
+    captains = [captain(seed + index) for index in range(games)]
+    turns = [0] * games
+    outcomes = dict()
+
+    # INPUT に艦長が答える（110 行で結果を取って止める）
+    def answer(batch, indices, line, statement, variable):
+        values = list()
+        for index in indices.tolist():
+            turns[index] = turns[index] + 1
+            value = None
+            if turns[index] <= max_turns:
+                instance = batch.instance(index)
+                if line == 110:
+                    outcomes[index] = score(instance._variables)
+                else:
+                    value = captains[index].answer(instance, line, variable)
+            if value is None:
+                batch.stop(index)
+                value = 0
+            values.append(value)
+        return values
+
+    # 一括実行（1 巡毎に止まったゲームの結果を返す）
+    batch = load(BatchTinyBasic(games, answer, seed = seed), path)
+    reported = np.zeros(games, bool)
+    start = time.perf_counter()
+    for active in batch.rounds():
+        finished = np.flatnonzero((batch._pcs < 0) & ~reported)
+        reported[finished] = True
+        for index in finished.tolist():
+            result = outcomes.get(index)
+            if result is None:
+                result = score(batch.instance(index)._variables)
+                result['outcome'] = 'timeout' if turns[index] > max_turns else 'error'
+                result['score'] = 0
+            # RND は全ゲームで 1 つの生成器から引くので、種は艦長の分だけ、時間は一括実行の開始からの経過
+            result.update({
+                'captain_seed': seed + index,
+                'turns': turns[index],
+                'statements': int(batch._counts[index]),
+                'elapsed': time.perf_counter() - start,
+                'game': index,
+            })
+            yield result
+
+
+# 艦長のクラスを取得する（名前、または module:Class）
+#
+def get_captain(name):
+    if name in CAPTAINS:
+        return CAPTAINS[name]
+    module, separator, attribute = name.partition(':')
+    if separator == '':
+        raise ValueError(f'unknown captain {name}.')
+    return getattr(importlib.import_module(module), attribute)
+
+
+# 結果を集計する
+#
+def summarize(results, seconds):
+    outcomes = dict()
+    for result in results:
+        outcomes[result['outcome']] = outcomes.get(result['outcome'], 0) + 1
+    accomplished = [result for result in results if result['outcome'] == 'accomplished']
+    statements = sum(result['statements'] for result in results)
+    return {
+        'games': len(results),
+        'outcomes': outcomes,
+        'score': sum(result['score'] for result in accomplished) / len(accomplished) if len(accomplished) > 0 else 0,
+        'stardates': sum(result['stardates'] for result in accomplished) / len(accomplished) if len(accomplished) > 0 else 0,
+        'casualties': sum(result['casualties'] for result in accomplished) / len(accomplished) if len(accomplished) > 0 else 0,
+        'statements': statements,
+        'seconds': seconds,
+        'games/sec': len(results) / seconds if seconds > 0 else 0,
+        'statements/sec': statements / seconds if seconds > 0 else 0,
+    }
+
+
+# アプリケーションのエントリポイント
+#
+if __name__ == '__main__':
+
+    # 引数の取得
+    parser = argparse.ArgumentParser(description = 'TinyTrek Monte Carlo simulator')
+    parser.add_argument('path', nargs = '?', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tinytrek.bas'), help = 'BASIC program')
+    parser.add_argument('--games', type = int, default = 100, help = 'number of games')
+    parser.add_argument('--jobs', type = int, default = None, help = 'worker processes (default: number of cores)')
+    parser.add_argument('--captain', default = 'hunter', help = "captain policy: 'random', 'hunter' or module:Class")
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the first game, game n uses seed + n')
+    parser.add_argument('--backend', default = 'bytecode', choices = BACKENDS)
+    parser.add_argument('--batch', action = 'store_true', help = 'run all games in lockstep in one process with NumPy (ignores --jobs and --backend, only pays off with about a thousand games)')
+    parser.add_argument('--max-turns', type = int, default = 2000, help = 'INPUTs answered before a game is abandoned')
+    parser.add_argument('--output', default = None, help = 'write one JSON line per game to this file (default: stdout)')
+    args = parser.parse_args()
+
+    # ゲームの実行（終わった順に 1 行ずつ出力）
+    output = open(args.output, 'w', encoding='UTF-8') if args.output is not None else sys.stdout
+    results = list()
+    start = time.perf_counter()
+    try:
+        if args.batch:
+            games = simulate_batch(args.path, args.games, get_captain(args.captain), args.seed, args.max_turns)
+        else:
+            games = simulate(args.path, args.games, get_captain(args.captain), args.jobs, args.seed, args.backend, args.max_turns)
+        for result in games:
+            results.append(result)
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    # 集計の出力
+    sys.stderr.write(json.dumps(summarize(results, time.perf_counter() - start)) + '\n')
@@ -0,0 +1,13 @@
+# conftest.py - テストの設定
+#
+
+
+# 参照
+#
+import os
+import sys
+
+
+# リポジトリのモジュールを読み込めるようにする
+#
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,78 @@
+# test_batch.py - 一括実行のテスト
+#
+
+
+# 参照
+#
+import pytest
+from headless import HeadlessTinyBasic
+
+
+# NumPy が無ければ一括実行のテストはしない
+#
+np = pytest.importorskip('numpy')
+from batch import BatchTinyBasic
+
+
+# INPUT の値で FOR/NEXT、GOSUB、@() とエラーの起き方が変わるプログラム
+# （5 は 0 での割り算、21 以上は @() の範囲外で止まる）
+#
+PROGRAM = '''10 IN.N
+20 F.I=1TON;@(I)=@(I-1)+I*N;F.J=NTO1S.-2;A=A+J;N.J;IFI=7G.30
+25 N.I
+30 GOS.100*(N/3+1);C=N*3000
+40 B=1000/(N-5)
+50 @(N*50)=N;STOP
+100 D=D+1;R.
+200 D=D+2;GOS.100;R.
+300 D=D+3;GOS.200;R.
+400 D=D+4;R.
+500 D=D+5;R.
+600 D=D+6;F.K=1TO3;GOS.100;N.K;R.
+700 D=D+7;R.
+800 D=D+8;GOS.700;R.
+'''
+
+
+# プログラムを書く
+#
+def write(tmp_path, name, source):
+    path = str(tmp_path / f'{name}.bas')
+    with open(path, 'w', encoding='UTF-8') as file:
+        file.write(source)
+    return path
+
+
+# インスタンス毎の変数、@() とステートメント数がスカラのインタプリタと同じになる
+#
+@pytest.mark.parametrize('backend', ['bytecode', 'python'])
+def test_parity(tmp_path, capsys, backend):
+    path = write(tmp_path, 'parity', PROGRAM)
+    count = 24
+    batch = BatchTinyBasic(count, lambda batch, indices, line, statement, variable: indices.tolist())
+    result = batch.run(path)
+    assert result['faults'] == 4
+    for index in range(count):
+        basic = HeadlessTinyBasic([str(index)], backend = backend)
+        basic.run(path)
+        assert batch._batch_slots[:, index].tolist() == list(basic._slots)
+        assert batch._batch_array[index].tolist() == list(basic._array)
+        assert int(batch._counts[index]) == basic._executed
+    capsys.readouterr()
+
+
+# FOR のスタックが溢れると最も古いフレームを捨てるので、外側の NEXT は対応するフレームが無く素通りする
+#
+def test_for_overflow(tmp_path):
+    path = write(tmp_path, 'overflow', '10 F.I=1TO2;F.J=1TO2;F.K=1TO2;N.K;N.J;N.I\n')
+    batch = BatchTinyBasic(3, depth = 2)
+    batch.run(path)
+    assert batch._batch_slots[8:11].T.tolist() == [[1, 3, 3]] * 3
+    assert batch._counts.tolist() == [12] * 3
+    assert not batch._faults.any()
+
+    # スカラのインタプリタのスタックは溢れない
+    basic = HeadlessTinyBasic([])
+    basic.run(path)
+    assert list(basic._slots[8:11]) == [3, 3, 3]
+    assert basic._executed == 22
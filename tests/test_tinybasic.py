@@ -0,0 +1,355 @@
+# test_tinybasic.py - Tiny BASIC のテスト
+#
+
+
+# 参照
+#
+import io
+import os
+import json
+import shutil
+import pickle
+import pytest
+import tinybasic
+from tinybasic import TinyBasic
+from tinybasic import BACKENDS
+from tinybasic import Snapshot
+from tinybasic import BufferedOutput
+from tinybasic import NullOutput
+from tinybasic import InputReplayer
+from tinybasic import InputRecorder
+from tinybasic import Profiler
+from headless import HeadlessTinyBasic
+
+
+# 記録したセッション
+#
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SESSION = os.path.join(ROOT, 'sessions', 'tinytrek.json')
+
+
+# エラーで止まるプログラム
+#
+ERRORS = {
+    'division': '10 F.I=1TO5\n20 A=A+I\n30 N.I\n40 B=R.(6);C=100/(A-15)\n50 PR."NOT REACHED"',
+    'array': '10 A=7;@(A)=3\n20 B=@(-1)\n30 PR."NOT REACHED"',
+    'return': '10 A=1;GOS.100;A=2;R.\n100 B=1;R.',
+    'goto': '10 A=1;G.99\n20 PR."NOT REACHED"',
+    'print': '10 H=10;PR.1,2/0\n20 H=15',
+}
+
+
+# 一時ディレクトリに写した TinyTrek（キャッシュをリポジトリに作らない）
+#
+@pytest.fixture(scope = 'module')
+def tinytrek(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('tinytrek') / 'tinytrek.bas')
+    shutil.copyfile(os.path.join(ROOT, 'tinytrek.bas'), path)
+    return path
+
+
+# 記録した INPUT の値
+#
+@pytest.fixture(scope = 'module')
+def values():
+    with open(SESSION, 'r', encoding='UTF-8') as file:
+        return [record['value'] for record in json.load(file)['inputs']]
+
+
+# セッションを再生して、ステートメント数と出力を返す
+#
+def replay(path, backend):
+    output = io.StringIO()
+    result = HeadlessTinyBasic([], output = output, backend = backend, replayer = InputReplayer(SESSION)).run(path)
+    return result['statements'], output.getvalue()
+
+
+# ジェネレータを values で答えながら進め、count 個に答えたら次の INPUT の (pc, 変数名) を返す
+#
+def play(basic, pc, values, count = None):
+    machine = basic.interpret(pc)
+    values = iter(values)
+    value = None
+    try:
+        while True:
+            pc, key = machine.send(value)
+            value = None
+            if key is not None:
+                if count == 0:
+                    return pc, key
+                value = next(values, None)
+                if value is None:
+                    return pc, key
+                if count is not None:
+                    count = count - 1
+    except StopIteration:
+        return -1, None
+
+
+# 出力を取っておく TinyBasic を作る
+#
+def create(path, **options):
+    text = io.StringIO()
+    basic = TinyBasic(output = BufferedOutput(text), **options)
+    assert basic.prepare(path)
+    return basic, text
+
+
+# 全てのバックエンドでセッションの再生の結果が同じになる
+#
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_replay(tinytrek, backend):
+    statements, output = replay(tinytrek, backend)
+    assert statements == 38486
+    assert output == replay(tinytrek, 'bytecode')[1]
+
+
+# 全てのバックエンドでエラーの位置と実行したステートメント数が同じになる
+#
+@pytest.mark.parametrize('name', sorted(ERRORS))
+def test_error(tmp_path, capsys, name):
+    path = str(tmp_path / f'{name}.bas')
+    with open(path, 'w', encoding='UTF-8') as file:
+        file.write(ERRORS[name] + '\n')
+    results = list()
+    for backend in BACKENDS:
+        basic = HeadlessTinyBasic([], backend = backend, seed = 1)
+        result = basic.run(path)
+        results.append((result['statements'], list(basic._slots), list(basic._array[:8])))
+        assert capsys.readouterr().err != ''
+    assert results.count(results[0]) == len(results)
+    assert 'NOT REACHED' not in capsys.readouterr().out
+
+
+# スナップショットのバイト列から戻した状態と、fork した状態が、元と同じように続く
+#
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_snapshot(tinytrek, values, backend):
+
+    # 途中の INPUT まで進めてスナップショットを取る
+    basic, text = create(tinytrek, backend = backend, seed = 1)
+    pc, key = play(basic, basic._targets[basic._start], values, 100)
+    assert key is not None
+    data = basic.snapshot(pc).to_bytes()
+    assert Snapshot.from_bytes(data).to_bytes() == data
+    other = basic.fork()
+    forked_text = io.StringIO()
+    other._output = BufferedOutput(forked_text)
+
+    # 元の続き
+    basic._output.flush()
+    start = len(text.getvalue())
+    play(basic, pc, values[100:])
+    basic._output.flush()
+    expected = (list(basic._slots), list(basic._array), text.getvalue()[start:])
+
+    # バイト列から戻した続き
+    restored, restored_text = create(tinytrek, backend = backend, seed = 2)
+    play(restored, restored.restore(Snapshot.from_bytes(data)), values[100:])
+    restored._output.flush()
+    assert (list(restored._slots), list(restored._array), restored_text.getvalue()) == expected
+
+    # fork した続き
+    play(other, pc, values[100:])
+    other._output.flush()
+    assert (list(other._slots), list(other._array), forked_text.getvalue()) == expected
+
+
+# 別のプログラムのスナップショットは戻せない
+#
+def test_snapshot_mismatch(tmp_path, tinytrek):
+    path = str(tmp_path / 'other.bas')
+    with open(path, 'w', encoding='UTF-8') as file:
+        file.write('10 A=1\n')
+    basic, text = create(tinytrek, seed = 1)
+    other = TinyBasic(output = NullOutput())
+    assert other.prepare(path)
+    with pytest.raises(ValueError):
+        other.restore(Snapshot.from_bytes(basic.snapshot(0).to_bytes()))
+
+
+# パーサの LALR 表は共有の一時ディレクトリではなく利用者のキャッシュディレクトリに置く
+#
+def test_lark_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    monkeypatch.setattr(TinyBasic, '_lark', None)
+    TinyBasic(output = NullOutput())._get_lark()
+    directory = tmp_path / 'tinybasic'
+    assert len(list(directory.glob('lark-*.cache'))) == 1
+    assert directory.stat().st_mode & 0o077 == 0
+
+
+# 範囲外の INPUT の値は 16bits 整数に丸めて変数に入れ、スナップショットにできる
+#
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_input_range(tmp_path, backend):
+    path = str(tmp_path / 'range.bas')
+    with open(path, 'w', encoding='UTF-8') as file:
+        file.write('10 IN.A\n20 B=A+1\n30 IN.C\n')
+    basic, text = create(path, backend = backend)
+    pc, key = play(basic, basic._targets[basic._start], [70000])
+    assert key == 'C'
+    assert basic._slots[:2] == [70000 - 0x10000, 70000 - 0x10000 + 1]
+    assert Snapshot.from_bytes(basic.snapshot(pc).to_bytes()).slots[:2] == basic._slots[:2]
+
+
+# 読み込んだプログラムのキャッシュを使えるかを返す
+#
+def load_cache(path, backend = 'bytecode'):
+    basic = TinyBasic(backend = backend, output = NullOutput())
+    basic._path = path
+    return basic._load_cache()
+
+
+# 実行して変数を返す
+#
+def run_slots(path, backend = 'bytecode'):
+    basic = HeadlessTinyBasic([], backend = backend, seed = 1)
+    basic.run(path)
+    return list(basic._slots)
+
+
+# キャッシュを使う読み込みと使わない読み込みで、全てのバックエンドの結果が同じになる
+#
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_cache(tmp_path, backend):
+    path = str(tmp_path / 'cache.bas')
+    with open(path, 'w', encoding='UTF-8') as file:
+        file.write('10 F.I=1TO3;A=A+I;N.I\n20 GOS.100;PR."A";B=R.(9)\n30 STOP\n100 @(2)=A*2;R.\n')
+    assert not load_cache(path, backend)
+    expected = run_slots(path, backend)
+    assert load_cache(path, backend)
+    assert run_slots(path, backend) == expected
+
+
+# 古いまたは壊れたキャッシュは使わずに解析し直し、キャッシュを書き直す
+#
+@pytest.mark.parametrize('change', ['edit', 'version', 'truncate', 'pickle'])
+def test_cache_fallback(tmp_path, monkeypatch, change):
+    path = str(tmp_path / 'stale.bas')
+    with open(path, 'w', encoding='UTF-8') as file:
+        file.write('10 A=1\n')
+    assert run_slots(path)[0] == 1
+    assert load_cache(path)
+
+    # ソースの編集
+    if change == 'edit':
+        with open(path, 'a', encoding='UTF-8') as file:
+            file.write('20 A=2\n')
+
+    # 版の更新
+    elif change == 'version':
+        monkeypatch.setattr(tinybasic, 'VERSION', '0.0.0')
+
+    # 途中で切れたファイル
+    elif change == 'truncate':
+        with open(path + '.cache', 'r+b') as file:
+            file.truncate(os.path.getsize(path + '.cache') // 2)
+
+    # 読み込むとコードが動く pickle
+    else:
+        marker = tmp_path / 'executed'
+        class Payload:
+            def __reduce__(self):
+                return (os.mkdir, (str(marker),))
+        with open(path + '.cache', 'wb') as file:
+            pickle.dump(Payload(), file)
+
+    # 解析し直した結果とキャッシュの書き直し
+    assert not load_cache(path)
+    assert run_slots(path)[0] == (2 if change == 'edit' else 1)
+    assert load_cache(path)
+    assert not (tmp_path / 'executed').exists()
+
+
+# プロファイラはステートメント毎、行毎の実行回数と GOSUB の呼び出し回数を全てのバックエンドで同じに数える
+#
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_profiler(tmp_path, backend):
+    path = str(tmp_path / 'profile.bas')
+    with open(path, 'w', encoding='UTF-8') as file:
+        file.write('10 F.I=1TO3;GOS.100;N.I\n20 STOP\n100 A=A+1;R.\n')
+    report = io.StringIO()
+    profiler = Profiler(str(tmp_path / 'profile.json'), file = report)
+    result = HeadlessTinyBasic([], backend = backend, profiler = profiler).run(path)
+    assert result['statements'] == 14
+    assert {key: count for key, (count, seconds) in profiler.statements.items()} == {
+        (10, 0): 1, (10, 1): 3, (10, 2): 3, (20, 0): 1, (100, 0): 3, (100, 1): 3,
+    }
+    assert {line: count for line, (count, seconds) in profiler.lines().items()} == {10: 7, 20: 1, 100: 6}
+    assert profiler.calls == {100: 3}
+
+    # 閉じると表と JSON を書き出す
+    assert report.getvalue().startswith('  line      count')
+    with open(tmp_path / 'profile.json', 'r', encoding='UTF-8') as file:
+        dump = json.load(file)
+    assert [(line['line'], line['count']) for line in dump['lines']] == [(10, 7), (20, 1), (100, 6)]
+    assert dump['gosubs'] == [{'line': 100, 'calls': 3}]
+
+
+# 記録した INPUT の値と乱数の種を再生すると、同じ出力と同じ変数になる
+#
+def test_record_replay(tmp_path):
+    path = str(tmp_path / 'record.bas')
+    with open(path, 'w', encoding='UTF-8') as file:
+        file.write('10 IN.A\n20 B=R.(1000)+A;PR.B\n30 IN.C\n40 PR.C*2\n')
+    session = str(tmp_path / 'session.json')
+    output = io.StringIO()
+    recorded = HeadlessTinyBasic(['12', '70000'], output = output, seed = 7, recorder = InputRecorder(session))
+    recorded.run(path)
+    with open(session, 'r', encoding='UTF-8') as file:
+        recording = json.load(file)
+    assert recording['program'] == 'record.bas'
+    assert recording['seed'] == 7
+    assert [(record['line'], record['variable'], record['value']) for record in recording['inputs']] == [(10, 'A', 12), (30, 'C', 70000 - 0x10000)]
+
+    # 再生（入力は使わない）
+    replayed_output = io.StringIO()
+    replayer = InputReplayer(session)
+    replayed = HeadlessTinyBasic([], output = replayed_output, replayer = replayer)
+    assert replayed.run(path)['inputs'] == 0
+    assert replayer.remaining() == 0
+    assert list(replayed._slots) == list(recorded._slots)
+    assert replayed_output.getvalue() == output.getvalue()
+
+
+# 記録と違う位置の INPUT では再生をやめる
+#
+def test_replay_diverged(tmp_path, capsys):
+    session = str(tmp_path / 'session.json')
+    with open(session, 'w', encoding='UTF-8') as file:
+        json.dump({'program': 'x.bas', 'seed': 1, 'inputs': [{'line': 10, 'statement': 0, 'variable': 'A', 'value': 1}]}, file)
+    replayer = InputReplayer(session)
+    assert replayer.read(10, 0, 'B') is None
+    assert replayer.remaining() == 0
+    assert 'replay diverged' in capsys.readouterr().err
+
+
+# BufferedOutput は limit 文字に達するか flush するまで書き込まず、NullOutput は何も書かない
+#
+def test_output(tmp_path, capsys):
+    file = io.StringIO()
+    output = BufferedOutput(file, limit = 4)
+    output.write('ab')
+    assert file.getvalue() == ''
+    output.write('cd')
+    assert file.getvalue() == 'abcd'
+    output.write('e')
+    output.flush()
+    assert file.getvalue() == 'abcde'
+
+    # 大きさでは書き込まない
+    file = io.StringIO()
+    output = BufferedOutput(file, limit = None)
+    output.write('x' * 100000)
+    assert file.getvalue() == ''
+    output.flush()
+    assert len(file.getvalue()) == 100000
+
+    # NullOutput に出力するとプログラムの PRINT は標準出力に出ない
+    path = str(tmp_path / 'print.bas')
+    with open(path, 'w', encoding='UTF-8') as file:
+        file.write('10 PR."HELLO"\n')
+    HeadlessTinyBasic([], output = NullOutput()).run(path)
+    TinyBasic(output = BufferedOutput()).run(path)
+    assert capsys.readouterr().out == 'HELLO\n'
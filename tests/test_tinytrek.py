@@ -0,0 +1,91 @@
+# test_tinytrek.py - TinyTrek のテスト
+#
+
+
+# 参照
+#
+import types
+import pytest
+from tinybasic import TinyBasic
+from tinybasic import NullOutput
+
+
+# Pyxel が無ければ TinyTrek のテストはしない
+#
+pyxel = pytest.importorskip('pyxel')
+import tinytrek
+from tinytrek import FrameScheduler
+from tinytrek import TextBuffer
+from tinytrek import Keyboard
+
+
+# 最下行に書いた文字だけが描画されていない範囲になり、行末を越えると改行してスクロールする
+#
+def test_text_buffer():
+    text = TextBuffer(4, 3)
+    assert sorted(text.flush()) == [(0, 0, '    '), (1, 0, '    '), (2, 0, '    ')]
+    assert text.flush() == []
+
+    # 書き込みと消去
+    text.putc('A')
+    text.putc('B')
+    assert text.flush() == [(2, 0, 'AB')]
+    text.backspace()
+    assert text.flush() == [(2, 1, ' ')]
+    assert text.column == 1
+
+    # 行末を越えたら先頭の行を空けて最下行にする
+    for c in 'CDEF':
+        text.putc(c)
+    assert text.top == 1
+    assert text.column == 1
+    assert sorted(text.flush()) == [(0, 0, 'F   '), (2, 1, 'CDE')]
+
+
+# 同じフレームに打たれた文字と制御キーは打たれた順に読める
+#
+def test_keyboard_order(monkeypatch):
+    keyboard = Keyboard()
+    keys = [pyxel.KEY_1, pyxel.KEY_RETURN, pyxel.KEY_KP_2, pyxel.KEY_A, pyxel.KEY_BACKSPACE, pyxel.KEY_SHIFT]
+    monkeypatch.setattr(tinytrek, 'pyxel', types.SimpleNamespace(input_keys = keys))
+    keyboard._ordered = True
+    keyboard.poll()
+    assert [keyboard.read() for i in range(6)] == ['1', '\r', '2', 'A', '\b', None]
+
+
+# 打たれた順のキーが無ければキーを走査し、溜めておく文字数を超えたら古いものを捨てる
+#
+def test_keyboard_scan(monkeypatch):
+    keyboard = Keyboard(limit = 2)
+    pressed = {pyxel.KEY_Z, pyxel.KEY_9, pyxel.KEY_DELETE}
+    monkeypatch.setattr(tinytrek, 'pyxel', types.SimpleNamespace(btnp = lambda key: key in pressed))
+    keyboard._ordered = False
+    keyboard.poll()
+    assert [keyboard.read() for i in range(3)] == ['Z', '\b', None]
+
+
+# INPUT まで実行したフレームの数を計上し、INPUT を待つフレームは 0 を計上して速度が下がる
+#
+def test_frame_scheduler(tmp_path):
+    path = str(tmp_path / 'frame.bas')
+    with open(path, 'w', encoding='UTF-8') as file:
+        file.write('10 F.I=1TO100;N.I\n20 IN.A\n')
+    basic = TinyBasic(output = NullOutput())
+    assert basic.prepare(path)
+    machine = basic.interpret(basic._targets[basic._start])
+    assert next(machine)[1] is None
+    scheduler = FrameScheduler(1)
+    scheduler.begin()
+    pc, key = scheduler.run(basic, machine)
+    assert key == 'A'
+    assert basic._executed == 102
+
+    # 実行したフレーム
+    scheduler.count(basic._executed)
+    assert scheduler.statements == 102
+    rate = scheduler.rate
+
+    # INPUT を待つフレーム
+    scheduler.count(basic._executed)
+    assert scheduler.statements == 0
+    assert scheduler.rate == pytest.approx(rate * 0.9)
@@ -5,7 +5,16 @@
 # 参照
 #
 import sys
+import os
 import re
+import argparse
+import hashlib
+import array
+import json
+import time
+import copy
+import struct
+from collections.abc import Mapping
 import random
 from lark import Lark
 from lark import Tree
@@ -13,15 +22,470 @@ from lark import Token
 from lark import Transformer
 
 
+# バージョン（キャッシュの互換性の判定に使う）
+#
+VERSION = '1.5.3'
+
+
+# バックエンド
+#
+BACKENDS = ('bytecode', 'closure', 'python', 'transformer')
+
+
+# バイトコード
+#
+OP_PUSH = 0
+OP_LOAD = 1
+OP_ALOAD = 2
+OP_ADD = 3
+OP_SUB = 4
+OP_MUL = 5
+OP_DIV = 6
+OP_GT = 7
+OP_GE = 8
+OP_LT = 9
+OP_LE = 10
+OP_EQ = 11
+OP_NE = 12
+OP_NEG = 13
+OP_ABS = 14
+OP_RND = 15
+OP_STORE = 16
+OP_ASTORE = 17
+OP_PRINT_STRING = 18
+OP_PRINT_NUMBER = 19
+OP_NEWLINE = 20
+OP_IF = 21
+OP_GOTO = 22
+OP_GOSUB = 23
+OP_RETURN = 24
+OP_FOR = 25
+OP_NEXT = 26
+OP_STOP = 27
+OP_INPUT = 28
+OP_CALL = 29
+
+
+# 文法
+#
+GRAMMAR = r'''
+    statement           :   command_let
+                        |   command_print
+                        |   command_input
+                        |   command_if
+                        |   command_goto
+                        |   command_gosub
+                        |   command_return
+                        |   command_for
+                        |   command_next
+                        |   command_stop
+    command_let         :   ("LET"i)? let ("," let)*
+    let                 :   (VARIABLE | array) "=" expression
+    command_print       :   ("PRINT"i | "PRIN."i | "PRI."i | "PR."i | "P."i) (STRING | expression | DIGIT)* ("," (STRING | expression | DIGIT))* COMMA?
+    command_input       :   ("INPUT"i | "INPU."i | "INP."i | "IN."i) prompt ("," prompt)*
+    command_if          :   "IF"i expression statement
+    command_goto        :   ("GOTO"i | "GOT."i | "GO."i | "G."i) expression
+    command_gosub       :   ("GOSUB"i | "GOSU."i | "GOS."i) expression
+    command_return      :   ("RETURN"i | "RETUR."i | "RETU"i | "RET."i | "RE."i | "R."i)
+    command_for         :   ("FOR"i | "FO."i | "F."i) VARIABLE "=" expression "TO"i expression (("STEP"i | "STE."i | "ST."i | "S."i) expression)?
+    command_next        :   ("NEXT"i | "NEX."i | "NE."i | "N."i) VARIABLE
+    command_stop        :   ("STOP"i | "STO."i | "ST."i | "S."i)
+    function_abs        :   ("ABS"i | "AB."i | "A."i) "(" expression ")"
+    function_rnd        :   ("RND"i | "RN."i | "R."i) "(" expression ")"
+    prompt              :   STRING* VARIABLE
+                        |   STRING ("," STRING)* VARIABLE
+    expression          :   sum
+                        |   sum ">" sum  -> greater
+                        |   sum ">=" sum -> greater_equal
+                        |   sum "<" sum  -> less
+                        |   sum "<=" sum -> less_equal
+                        |   sum "=" sum  -> equal
+                        |   sum "#" sum  -> not_equal
+    sum                 :   product
+                        |   sum "+" product -> addition
+                        |   sum "-" product -> subtraction
+    product             :   atom
+                        |   product "*" atom -> multiply
+                        |   product "/" atom -> division
+    atom                :   positive
+                        |   negative
+                        |   "(" expression ")"
+    positive            :   "+"? factor
+    negative            :   "-" factor
+    factor              :   NUMBER
+                        |   VARIABLE
+                        |   array
+                        |   function_abs
+                        |   function_rnd
+    VARIABLE            :   /[A-Za-z]/
+    array               :   "@" "(" expression ")"
+    NUMBER              :   /[0-9]+/
+    STRING              :   /[\"][^\"]*[\"]|[\'][^\']*[\']|[\"][^\"]*$|[\'][^\']*$/
+    DIGIT.-1            :   /#[0-9]+/
+    COMMA               :   ","
+    %import common (WS)
+    %ignore WS
+'''
+
+
+# 出力をまとめて書き込む出力先（INPUT の待ち、終了、limit 文字を超えたときに書き込む、limit が None なら大きさでは書き込まない）
+#
+class BufferedOutput:
+
+    # コンストラクタ
+    def __init__(self, file = None, limit = 8192):
+        self._file = file
+        self._limit = limit
+        self._strings = list()
+        self._size = 0
+
+    # 文字列を書き込む
+    def write(self, string):
+        self._strings.append(string)
+        self._size = self._size + len(string)
+        if self._limit is not None and self._size >= self._limit:
+            self.flush()
+
+    # フラッシュする
+    def flush(self):
+        if self._strings:
+            self._get_file().write(''.join(self._strings))
+            self._strings.clear()
+            self._size = 0
+        self._get_file().flush()
+
+    # 書き込むファイルを取得する（指定が無ければその時点の標準出力）
+    def _get_file(self):
+        return self._file if self._file is not None else sys.stdout
+
+
+# 出力を捨てる出力先
+#
+class NullOutput:
+
+    # 文字列を書き込む
+    def write(self, string):
+        pass
+
+    # フラッシュする
+    def flush(self):
+        pass
+
+
+# テキストのトレース出力先
+#
+class TextTraceSink:
+
+    # コンストラクタ
+    def __init__(self, file = None):
+        self._file = file
+
+    # イベントを書き込む
+    def write(self, event):
+        fields = ' '.join(f'{key}={value}' for key, value in event.items() if key != 'event')
+        self._get_file().write(f"{event['event']}: {fields}\n")
+
+    # 閉じる
+    def close(self):
+        self._get_file().flush()
+
+    # 書き込むファイルを取得する（指定が無ければその時点の標準エラー出力）
+    def _get_file(self):
+        return self._file if self._file is not None else sys.stderr
+
+
+# JSON Lines のトレース出力先
+#
+class JsonTraceSink:
+
+    # コンストラクタ
+    def __init__(self, path):
+        self._file = open(path, 'w', encoding='UTF-8')
+
+    # イベントを書き込む
+    def write(self, event):
+        self._file.write(json.dumps(event, default = str) + '\n')
+
+    # 閉じる
+    def close(self):
+        self._file.close()
+
+
+# メモリ上のトレース出力先
+#
+class ListTraceSink:
+
+    # コンストラクタ
+    def __init__(self):
+        self.events = list()
+
+    # イベントを書き込む
+    def write(self, event):
+        self.events.append(event)
+
+    # 閉じる
+    def close(self):
+        pass
+
+
+# 行毎の実行プロファイラ
+#
+class Profiler:
+
+    # コンストラクタ（path には JSON を、file には表を書き出す、file が無ければその時点の標準エラー出力）
+    def __init__(self, path = None, file = None, limit = 20):
+        self._path = path
+        self._file = file
+        self._limit = limit
+        self.statements = dict()
+        self.calls = dict()
+
+    # ステートメントの実行を記録する
+    def record(self, line, statement, seconds):
+        entry = self.statements.get((line, statement))
+        if entry is None:
+            self.statements[(line, statement)] = [1, seconds]
+        else:
+            entry[0] = entry[0] + 1
+            entry[1] = entry[1] + seconds
+
+    # GOSUB の呼び出しを記録する
+    def call(self, line):
+        self.calls[line] = self.calls.get(line, 0) + 1
+
+    # 行毎に集計する
+    def lines(self):
+        result = dict()
+        for (line, statement), (count, seconds) in self.statements.items():
+            entry = result.setdefault(line, [0, 0.0])
+            entry[0] = entry[0] + count
+            entry[1] = entry[1] + seconds
+        return result
+
+    # 表を作成する
+    def report(self):
+        lines = sorted(self.lines().items(), key = lambda item: item[1][1], reverse = True)
+        statements = sorted(self.statements.items(), key = lambda item: item[1][1], reverse = True)
+        calls = sorted(self.calls.items(), key = lambda item: item[1], reverse = True)
+        total = sum(seconds for count, seconds in self.statements.values())
+        result = [f'{"line":>6s} {"count":>10s} {"ms":>10s} {"%":>6s}']
+        for line, (count, seconds) in lines[:self._limit]:
+            result.append(f'{line:6d} {count:10d} {seconds * 1000:10.3f} {seconds * 100 / total if total > 0 else 0:6.1f}')
+        result.append('')
+        result.append(f'{"stmt":>9s} {"count":>10s} {"ms":>10s}')
+        for (line, statement), (count, seconds) in statements[:self._limit]:
+            result.append(f'{line:6d}:{statement:<2d} {count:10d} {seconds * 1000:10.3f}')
+        result.append('')
+        result.append(f'{"gosub":>6s} {"calls":>10s}')
+        for line, count in calls[:self._limit]:
+            result.append(f'{line:6d} {count:10d}')
+        return '\n'.join(result) + '\n'
+
+    # 機械可読な形式にする
+    def dump(self):
+        return {
+            'lines': [
+                {'line': line, 'count': count, 'seconds': seconds}
+                for line, (count, seconds) in sorted(self.lines().items())
+            ],
+            'statements': [
+                {'line': line, 'statement': statement, 'count': count, 'seconds': seconds}
+                for (line, statement), (count, seconds) in sorted(self.statements.items())
+            ],
+            'gosubs': [
+                {'line': line, 'calls': count}
+                for line, count in sorted(self.calls.items())
+            ],
+        }
+
+    # 閉じる（表と JSON を書き出す）
+    def close(self):
+        file = self._file if self._file is not None else sys.stderr
+        file.write(self.report())
+        file.flush()
+        if self._path is not None:
+            with open(self._path, 'w', encoding='UTF-8') as file:
+                json.dump(self.dump(), file, indent = 4)
+
+
+# INPUT の値の記録
+#
+class InputRecorder:
+
+    # コンストラクタ
+    def __init__(self, path):
+        self._path = path
+        self.program = None
+        self.seed = None
+        self.inputs = list()
+
+    # プログラムと乱数の種を記録する
+    def begin(self, program, seed):
+        self.program = os.path.basename(program)
+        self.seed = seed
+
+    # INPUT の値を記録する
+    def write(self, line, statement, variable, value):
+        self.inputs.append({'line': line, 'statement': statement, 'variable': variable, 'value': value})
+
+    # 閉じる（JSON を 1 つの値につき 1 行で書き出す）
+    def close(self):
+        with open(self._path, 'w', encoding='UTF-8') as file:
+            file.write(f'{{"program": {json.dumps(self.program)}, "seed": {json.dumps(self.seed)}, "inputs": [\n')
+            file.write(',\n'.join(json.dumps(value) for value in self.inputs))
+            file.write('\n]}\n')
+
+
+# 記録した INPUT の値の再生
+#
+class InputReplayer:
+
+    # コンストラクタ（InputRecorder の書いた JSON を読む）
+    def __init__(self, path):
+        with open(path, 'r', encoding='UTF-8') as file:
+            recording = json.load(file)
+        self.seed = recording.get('seed')
+        self._inputs = recording['inputs']
+        self._index = 0
+
+    # 次の値を読む（位置が違う、または終わりでは None）
+    def read(self, line, statement, variable):
+        if self._index >= len(self._inputs):
+            return None
+        record = self._inputs[self._index]
+        if (record['line'], record['statement'], record['variable']) != (line, statement, variable):
+            sys.stderr.write(f"replay diverged at {line}:{statement} {variable}, expected {record['line']}:{record['statement']} {record['variable']}.\n")
+            self._index = len(self._inputs)
+            return None
+        self._index = self._index + 1
+        return record['value']
+
+    # 残りの値の数を取得する
+    def remaining(self):
+        return len(self._inputs) - self._index
+
+
+# 変数 A-Z の読み取り専用のビュー
+#
+class VariableView(Mapping):
+
+    # コンストラクタ
+    def __init__(self, slots):
+        self._slots = slots
+
+    # 変数の値を取得する
+    def __getitem__(self, key):
+        if type(key) is not str or len(key) != 1 or not 'A' <= key <= 'Z':
+            raise KeyError(key)
+        return self._slots[ord(key) - ord('A')]
+
+    # 変数名を列挙する
+    def __iter__(self):
+        return iter('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+    # 変数の数を取得する
+    def __len__(self):
+        return len(self._slots)
+
+
+# FOR のループの状態
+#
+class ForFrame:
+
+    # 固定のレイアウト
+    __slots__ = ('pc', 'slot', 'limit', 'step')
+
+    # コンストラクタ
+    def __init__(self, pc, slot, limit, step):
+        self.pc = pc
+        self.slot = slot
+        self.limit = limit
+        self.step = step
+
+
+# 実行状態の写し
+#
+class Snapshot:
+
+    # 固定のレイアウト
+    __slots__ = ('digest', 'pc', 'slots', 'array', 'gosubs', 'fors', 'random')
+
+    # バイト列の形式（識別子、形式の版、プログラムのダイジェスト、PC、配列の大きさ、GOSUB と FOR の深さ）
+    HEADER = struct.Struct('<4sB32siHII')
+    MAGIC = b'TBSS'
+    FORMAT = 1
+
+    # コンストラクタ
+    def __init__(self, digest, pc, slots, array, gosubs, fors, random):
+        self.digest = digest
+        self.pc = pc
+        self.slots = slots
+        self.array = array
+        self.gosubs = gosubs
+        self.fors = fors
+        self.random = random
+
+    # バイト列にする
+    def to_bytes(self):
+        version, state, gauss = self.random
+        frames = [value for frame in self.fors for value in frame[1:]]
+        return b''.join([
+            Snapshot.HEADER.pack(Snapshot.MAGIC, Snapshot.FORMAT, bytes.fromhex(self.digest) if self.digest is not None else bytes(32), self.pc, len(self.array), len(self.gosubs), len(self.fors)),
+            struct.pack('<26h', *self.slots),
+            struct.pack(f'<{len(self.array)}h', *self.array),
+            struct.pack(f'<{len(self.gosubs)}i', *self.gosubs),
+            struct.pack(f'<{len(self.fors)}i', *[frame[0] for frame in self.fors]),
+            struct.pack(f'<{len(frames)}h', *frames),
+            struct.pack(f'<i{len(state)}I?d', version, *state, gauss is not None, gauss if gauss is not None else 0.0),
+        ])
+
+    # バイト列から作る
+    @staticmethod
+    def from_bytes(data):
+
+        # ヘッダ
+        magic, format, digest, pc, size, gosubs, fors = Snapshot.HEADER.unpack_from(data)
+        if magic != Snapshot.MAGIC or format != Snapshot.FORMAT:
+            raise ValueError('not a Tiny BASIC snapshot.')
+        offset = Snapshot.HEADER.size
+
+        # 固定長の並びを順に読む
+        def read(code, count):
+            nonlocal offset
+            values = struct.unpack_from(f'<{count}{code}', data, offset)
+            offset = offset + struct.calcsize(f'<{count}{code}')
+            return values
+        slots = list(read('h', 26))
+        values = array.array('h', read('h', size))
+        stack = list(read('i', gosubs))
+        pcs = read('i', fors)
+        frames = read('h', fors * 3)
+        version = read('i', 1)[0]
+        state = read('I', 625)
+        exists, gauss = struct.unpack_from('<?d', data, offset)
+        return Snapshot(
+            digest.hex() if digest != bytes(32) else None, pc, slots, values, stack, 
+            [(pcs[i], frames[i * 3], frames[i * 3 + 1], frames[i * 3 + 2]) for i in range(fors)], 
+            (version, state, gauss if exists else None)
+        )
+
+
 # Tiny BASIC クラス
 #
 class TinyBasic(Transformer):
 
+    # パーサ（全インスタンスで共有）
+    _lark = None
+
+    # パーサの LALR 表のキャッシュファイル（None なら利用者のキャッシュディレクトリ、False ならディスクにはキャッシュしない）
+    _lark_cache = None
+
     # コンストラクタ
-    def __init__(self):
+    def __init__(self, backend = 'bytecode', dump = None, tracer = None, array_size = 1024, profiler = None, seed = None, recorder = None, replayer = None, output = None):
 
         # パスの初期化
         self._path = None
+        self._digest = None
 
         # リストの初期化
         self._lines = dict()
@@ -29,14 +493,44 @@ class TinyBasic(Transformer):
         self._nexts = dict()
         self._start = -1
 
-        # ツリーの初期化
-        self._trees = dict()
+        # ステートメントの初期化（PC を添字とする一次元の並び）
+        self._statements = list()
+        self._positions = list()
+        self._targets = dict()
+        self._elses = list()
 
-        # 変数の初期化
-        self._variables = dict()
+        # バイトコードの初期化
+        self._codes = list()
+
+        # バックエンドの初期化（BACKENDS のいずれか）
+        if backend not in BACKENDS:
+            raise ValueError(f'unknown backend {backend}.')
+        self._backend = backend
 
-        # 配列の初期化
-        self._array = dict()
+        # 生成コードの初期化
+        self._dump = dump
+        self._program = None
+
+        # 変数の初期化
+        self._slots = [0] * 26
+        self._variables = VariableView(self._slots)
+
+        # 配列の初期化（16bits の連続領域、添字は & 0xffff で負数を範囲外にする）
+        if not 0 < array_size <= 0x8000:
+            raise ValueError(f'array size {array_size} is out of range.')
+        self._array = array.array('h', [0]) * array_size
+
+        # 乱数の初期化（種が無ければ再生する記録の種、それも無ければ無作為に選ぶ）
+        if seed is None and replayer is not None:
+            seed = replayer.seed
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        self._seed = seed
+        self._random = random.Random(seed)
+
+        # INPUT の記録と再生の初期化
+        self._recorder = recorder
+        self._replayer = replayer
 
         # GOSUB の初期化
         self._gosubs = list()
@@ -44,26 +538,206 @@ class TinyBasic(Transformer):
         # FOR の初期化
         self._fors = list()
 
-        # デバッグの初期化
-        self._debug = False
+        # 出力の初期化（write と flush を持つもの）
+        self._output = output if output is not None else BufferedOutput()
+
+        # トレースの初期化
+        self._tracer = tracer
+
+        # プロファイラの初期化
+        self._profiler = profiler
+
+        # 実行したステートメント数の初期化
+        self._executed = 0
+
+        # 実行関数の選択
+        if backend == 'transformer':
+            self._runner = self._run_transformer
+        elif backend == 'python':
+            self._runner = self._run_program
+        else:
+            self._runner = self._run_vm
 
     # Tiny BASIC を実行する
     def run(self, path):
 
+        # プログラムの準備
+        if not self.prepare(path):
+            exit()
+
+        # プログラムの実行
+        try:
+            if self._recorder is not None:
+                self._recorder.begin(self._path, self._seed)
+            result = self._execute()
+
+        # 出力を書き出し、トレース、プロファイラ、記録を閉じる
+        finally:
+            self._output.flush()
+            if self._tracer is not None:
+                self._tracer.close()
+            if self._profiler is not None:
+                self._profiler.close()
+            if self._recorder is not None:
+                self._recorder.close()
+
+        # 終了
+        if not result:
+            exit()
+
+    # プログラムを読み込んで実行できるようにする（失敗すれば False）
+    def prepare(self, path):
+
         # パスの設定
         self._path = path
 
+        # キャッシュの読み込み
+        cached = self._load_cache()
+
         # ファイルの読み込み
-        if not self._load():
-            exit()
+        if not cached and not self._load():
+            return False
 
         # リストの解析
-        if not self._parse():
-            exit()
+        if not cached and not self._parse():
+            return False
 
-        # プログラムの実行
-        if not self._execute():
-            exit()
+        # バイトコードへのコンパイル
+        if not self._compile():
+            return False
+
+        # キャッシュの書き込み
+        if not cached:
+            self._save_cache()
+
+        # 終了
+        return True
+
+    # 実行状態の写しを作る
+    def snapshot(self, pc):
+        return Snapshot(
+            self._digest, pc, list(self._slots), array.array('h', self._array), list(self._gosubs), 
+            [(frame.pc, frame.slot, frame.limit, frame.step) for frame in self._fors], 
+            self._random.getstate()
+        )
+
+    # 実行状態を戻して PC を返す（変数と配列は同じオブジェクトの中身を書き換える）
+    def restore(self, snapshot):
+        if snapshot.digest != self._digest:
+            raise ValueError('the snapshot is for another program.')
+        if len(snapshot.array) != len(self._array):
+            raise ValueError(f'the snapshot has {len(snapshot.array)} array elements, not {len(self._array)}.')
+        self._slots[:] = snapshot.slots
+        self._array[:] = snapshot.array
+        self._gosubs[:] = snapshot.gosubs
+        self._fors[:] = [ForFrame(*frame) for frame in snapshot.fors]
+        self._random.setstate(snapshot.random)
+        return snapshot.pc
+
+    # コンパイル済みのプログラムを共有し、実行状態だけを複製する（トレース、プロファイラ、記録と再生は外す）
+    def fork(self):
+        other = copy.copy(self)
+        other._slots = list(self._slots)
+        other._variables = VariableView(other._slots)
+        other._array = array.array('h', self._array)
+        other._gosubs = list(self._gosubs)
+        other._fors = [ForFrame(frame.pc, frame.slot, frame.limit, frame.step) for frame in self._fors]
+        other._random = random.Random()
+        other._random.setstate(self._random.getstate())
+        other._tracer = None
+        other._profiler = None
+        other._recorder = None
+        other._replayer = None
+        other._executed = 0
+        other._runner = getattr(other, self._runner.__name__)
+        if self._backend == 'closure':
+            other._codes = list()
+            other._compile()
+        return other
+
+    # キャッシュファイルのパスを取得する
+    def _get_cache_path(self):
+        return self._path + '.cache'
+
+    # キャッシュを読み込む
+    def _load_cache(self):
+
+        # キャッシュの読み込み（JSON なので読むだけでコードが動くことは無い、版とダイジェストを確かめてから展開する）
+        try:
+            with open(self._path, 'rb') as file:
+                self._digest = hashlib.sha256(VERSION.encode() + file.read()).hexdigest()
+            with open(self._get_cache_path(), 'r', encoding='UTF-8') as file:
+                cache = json.load(file)
+            if cache['version'] != VERSION or cache['digest'] != self._digest:
+                return False
+            lines = {int(number): line for number, line in cache['lines'].items()}
+            lists = {int(number): {int(statement): text for statement, text in statements.items()} for number, statements in cache['lists'].items()}
+            nexts = {int(number): following for number, following in cache['nexts'].items()}
+            start = cache['start']
+            statements = [self._decode_tree(tree) for tree in cache['statements']]
+            positions = [tuple(position) for position in cache['positions']]
+            targets = {int(number): pc for number, pc in cache['targets'].items()}
+            elses = cache['elses']
+            codes = [tuple((op, tuple(arg) if type(arg) is list else arg) for op, arg in code) for code in cache['codes']] if self._backend == 'bytecode' else list()
+
+        # 古いまたは壊れたキャッシュは使わない
+        except Exception:
+            return False
+
+        # キャッシュの展開
+        self._lines = lines
+        self._lists = lists
+        self._nexts = nexts
+        self._start = start
+        self._statements = statements
+        self._positions = positions
+        self._targets = targets
+        self._elses = elses
+        self._codes = codes
+
+        # 終了
+        return True
+
+    # キャッシュを書き込む
+    def _save_cache(self):
+
+        # キャッシュの作成
+        cache = {
+            'version': VERSION, 
+            'digest': self._digest, 
+            'lines': self._lines, 
+            'lists': self._lists, 
+            'nexts': self._nexts, 
+            'start': self._start, 
+            'statements': [self._encode_tree(tree) for tree in self._statements], 
+            'positions': self._positions, 
+            'targets': self._targets, 
+            'elses': self._elses, 
+            'codes': self._codes if self._backend == 'bytecode' else list(), 
+        }
+
+        # 一時ファイルに書いてから置き換える
+        path = self._get_cache_path()
+        try:
+            with open(path + '.tmp', 'w', encoding='UTF-8') as file:
+                json.dump(cache, file, separators = (',', ':'))
+            os.replace(path + '.tmp', path)
+
+        # キャッシュが書けなくても実行は続ける
+        except Exception:
+            pass
+
+    # ツリーを JSON で書ける形にする（トークンは [種類, 値]）
+    def _encode_tree(self, tree):
+        if isinstance(tree, Token):
+            return [tree.type, tree.value]
+        return {'data': str(tree.data), 'children': [self._encode_tree(child) for child in tree.children]}
+
+    # JSON から読んだ形をツリーに戻す
+    def _decode_tree(self, value):
+        if type(value) is list:
+            return Token(value[0], value[1])
+        return Tree(value['data'], [self._decode_tree(child) for child in value['children']])
 
     # ファイルを読み込む
     def _load(self):
@@ -134,86 +808,15 @@ class TinyBasic(Transformer):
         # Lark による解析
         try:
 
-            # 文法の定義
-            lark = Lark(r'''
-                statement           :   command_let
-                                    |   command_print
-                                    |   command_input
-                                    |   command_if
-                                    |   command_goto
-                                    |   command_gosub
-                                    |   command_return
-                                    |   command_for
-                                    |   command_next
-                                    |   command_stop
-                command_let         :   ("LET"i)? let ("," let)*
-                let                 :   (VARIABLE | array) "=" expression
-                command_print       :   ("PRINT"i | "PRIN."i | "PRI."i | "PR."i | "P."i) (STRING | expression | DIGIT)* ("," (STRING | expression | DIGIT))* COMMA?
-                command_input       :   ("INPUT"i | "INPU."i | "INP."i | "IN."i) prompt ("," prompt)*
-                command_if          :   "IF"i expression statement
-                command_goto        :   ("GOTO"i | "GOT."i | "GO."i | "G."i) expression
-                command_gosub       :   ("GOSUB"i | "GOSU."i | "GOS."i) expression
-                command_return      :   ("RETURN"i | "RETUR."i | "RETU"i | "RET."i | "RE."i | "R."i)
-                command_for         :   ("FOR"i | "FO."i | "F."i) VARIABLE "=" expression "TO"i expression (("STEP"i | "STE."i | "ST."i | "S."i) expression)?
-                command_next        :   ("NEXT"i | "NEX."i | "NE."i | "N."i) VARIABLE
-                command_stop        :   ("STOP"i | "STO."i | "ST."i | "S."i)
-                function_abs        :   ("ABS"i | "AB."i | "A."i) "(" expression ")"
-                function_rnd        :   ("RND"i | "RN."i | "R."i) "(" expression ")"
-                prompt              :   STRING* VARIABLE
-                                    |   STRING ("," STRING)* VARIABLE
-                expression          :   sum
-                                    |   sum ">" sum  -> greater
-                                    |   sum ">=" sum -> greater_equal
-                                    |   sum "<" sum  -> less
-                                    |   sum "<=" sum -> less_equal
-                                    |   sum "=" sum  -> equal
-                                    |   sum "#" sum  -> not_equal
-                sum                 :   product
-                                    |   sum "+" product -> addition
-                                    |   sum "-" product -> subtraction
-                product             :   atom
-                                    |   product "*" atom -> multiply
-                                    |   product "/" atom -> division
-                atom                :   positive
-                                    |   negative
-                                    |   "(" expression ")"
-                positive            :   "+"? factor
-                negative            :   "-" factor
-                factor              :   NUMBER
-                                    |   VARIABLE
-                                    |   array
-                                    |   function_abs
-                                    |   function_rnd
-                VARIABLE            :   /[A-Za-z]/
-                array               :   "@" "(" expression ")"
-                NUMBER              :   /[0-9]+/
-                STRING              :   /[\"][^\"]*[\"]|[\'][^\']*[\']|[\"][^\"]*$|[\'][^\']*$/
-                DIGIT.-1            :   /#[0-9]+/
-                COMMA               :   ","
-                %import common (WS)
-                %ignore WS
-            ''', parser='lalr', start='statement')
+            # パーサの取得
+            lark = self._get_lark()
 
             # リストの解析
+            trees = dict()
             for number in self._lists.keys():
-                count = 0
+                trees[number] = list()
                 for statement in self._lists[number].keys():
-                    if number not in self._trees:
-                        self._trees[number] = dict()
-                    tree = lark.parse(self._lists[number][statement])
-                    if tree.data == 'statement':
-                        if tree.children[0].data == 'command_if':
-                            self._trees[number][count] = Tree('statement', [Tree('command_if', [tree.children[0].children[0]])])
-                            count = count + 1
-                            self._trees[number][count] = tree.children[0].children[1]
-                            count = count + 1
-                        elif tree.children[0].data == 'command_input':
-                            for child in tree.children[0].children:
-                                self._trees[number][count] = Tree('statement', [Tree('command_input', [child])])
-                                count = count + 1
-                        else:
-                            self._trees[number][count] = tree
-                            count = count + 1
+                    trees[number].extend(self._split(lark.parse(self._lists[number][statement])))
 
         # 例外
         except Exception as e:
@@ -224,120 +827,885 @@ class TinyBasic(Transformer):
         finally:
             pass
 
+        # ステートメントの平坦化
+        self._flatten(trees)
+
         # 終了
         return True
 
+    # 行毎のツリーを PC で並べた一次元のリストにする
+    def _flatten(self, trees):
+
+        # ファイル上の行の順に並べる
+        number = self._nexts.get(-1)
+        while number is not None and number not in self._targets:
+            self._targets[number] = len(self._statements)
+            for statement, tree in enumerate(trees.get(number, list())):
+                self._statements.append(tree)
+                self._positions.append((number, statement))
+            self._elses.extend([len(self._statements)] * (len(self._statements) - len(self._elses)))
+            number = self._nexts.get(number)
+
+        # 最後の行の後ろに STOP を置く
+        self._statements.append(Tree('statement', [Tree('command_stop', [])]))
+        self._positions.append((0, 0))
+        self._elses.append(len(self._statements) - 1)
+
+    # パーサを取得する
+    def _get_lark(self):
+
+        # LALR 表はプロセス内で一度だけ作成し、利用者だけが書ける場所にキャッシュする
+        if TinyBasic._lark is None:
+            TinyBasic._lark = Lark(GRAMMAR, parser='lalr', start='statement', cache=self._get_lark_cache_path())
+        return TinyBasic._lark
+
+    # パーサのキャッシュファイルのパスを取得する
+    # lark は読み込むときに pickle を使うので、共有の一時ディレクトリではなく自分の持ち物のディレクトリに置き、
+    # 用意できなければ False を返してディスクにはキャッシュしない
+    def _get_lark_cache_path(self):
+        if TinyBasic._lark_cache is not None:
+            return TinyBasic._lark_cache
+        directory = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'tinybasic')
+        try:
+            os.makedirs(directory, mode = 0o700, exist_ok = True)
+            if hasattr(os, 'getuid') and os.stat(directory).st_uid != os.getuid():
+                return False
+        except OSError:
+            return False
+        return os.path.join(directory, f'lark-{hashlib.sha256(GRAMMAR.encode()).hexdigest()[:16]}.cache')
+
+    # ステートメントを IF と INPUT の単位に分割する
+    def _split(self, tree):
+        result = list()
+        if tree.data == 'statement':
+            if tree.children[0].data == 'command_if':
+                result.append(Tree('statement', [Tree('command_if', [tree.children[0].children[0]])]))
+                result.extend(self._split(tree.children[0].children[1]))
+            elif tree.children[0].data == 'command_input':
+                for child in tree.children[0].children:
+                    result.append(Tree('statement', [Tree('command_input', [child])]))
+            else:
+                result.append(tree)
+        return result
+
     # コンパイルする
     def _compile(self):
-        pass
+
+        # バイトコードの生成（transformer はツリーをそのまま実行するので作らない）
+        try:
+            if self._backend == 'python':
+                self._compile_python()
+            elif self._backend != 'transformer' and len(self._codes) == 0:
+                for pc, tree in enumerate(self._statements):
+                    code = list()
+                    self._compile_statement(tree.children[0], code, pc)
+                    self._codes.append(tuple(code))
+
+        # 例外
+        except Exception as e:
+            sys.stderr.write(f'{e}\n')
+            return False
+
+        # コンパイルの完了
+        finally:
+            pass
+
+        # 終了
+        return True
+
+    # NEXT に対応する FOR のループ本体の PC を静的に求める
+    def _bind_next(self, pc):
+
+        # 同じ変数の直前の FOR に結び付ける（実行時に違えば動的に探す）
+        slot = self._slot(self._statements[pc].children[0].children[0])
+        for i in range(pc - 1, -1, -1):
+            tree = self._statements[i].children[0]
+            if tree.data == 'command_for' and self._slot(tree.children[0]) == slot:
+                return i + 1
+        return -1
+
+    # ステートメントをコンパイルする
+    def _compile_statement(self, tree, code, pc):
+
+        # LET
+        if tree.data == 'command_let':
+            for let in tree.children:
+                target = let.children[0]
+                if isinstance(target, Token):
+                    self._compile_expression(let.children[1], code)
+                    code.append((OP_STORE, self._slot(target)))
+                else:
+                    self._compile_expression(target.children[0], code)
+                    self._compile_expression(let.children[1], code)
+                    code.append((OP_ASTORE, None))
+
+        # PRINT
+        elif tree.data == 'command_print':
+            digit = 6
+            cr = True
+            for element in tree.children:
+                if isinstance(element, Tree):
+                    self._compile_expression(element, code)
+                    code.append((OP_PRINT_NUMBER, digit))
+                elif element.type == 'STRING':
+                    code.append((OP_PRINT_STRING, self._unquote(element.value)))
+                elif element.type == 'DIGIT':
+                    digit = self._int16(element.value[1:])
+                elif element.type == 'COMMA':
+                    cr = False
+            if cr:
+                code.append((OP_NEWLINE, None))
+
+        # INPUT
+        elif tree.data == 'command_input':
+            prompt = tree.children[0].children
+            if len(prompt) > 1:
+                for i in range(len(prompt) - 1):
+                    code.append((OP_PRINT_STRING, self._unquote(prompt[i].value)))
+            else:
+                code.append((OP_PRINT_STRING, prompt[0].value.upper()))
+            code.append((OP_PRINT_STRING, ':'))
+            code.append((OP_INPUT, prompt[len(prompt) - 1].value.upper()))
+
+        # IF
+        elif tree.data == 'command_if':
+            self._compile_expression(tree.children[0], code)
+            code.append((OP_IF, None))
+            if len(tree.children) > 1:
+                self._compile_statement(tree.children[1].children[0], code, pc)
+
+        # GOTO
+        elif tree.data == 'command_goto':
+            self._compile_expression(tree.children[0], code)
+            code.append((OP_GOTO, None))
+
+        # GOSUB
+        elif tree.data == 'command_gosub':
+            self._compile_expression(tree.children[0], code)
+            code.append((OP_GOSUB, None))
+
+        # RETURN
+        elif tree.data == 'command_return':
+            code.append((OP_RETURN, None))
+
+        # FOR
+        elif tree.data == 'command_for':
+            self._compile_expression(tree.children[1], code)
+            self._compile_expression(tree.children[2], code)
+            if len(tree.children) >= 4:
+                self._compile_expression(tree.children[3], code)
+            else:
+                code.append((OP_PUSH, 1))
+            code.append((OP_FOR, self._slot(tree.children[0])))
+
+        # NEXT
+        elif tree.data == 'command_next':
+            code.append((OP_NEXT, (self._slot(tree.children[0]), self._bind_next(pc))))
+
+        # STOP
+        elif tree.data == 'command_stop':
+            code.append((OP_STOP, None))
+
+    # 式をコンパイルする
+    def _compile_expression(self, tree, code):
+
+        # クロージャへのコンパイル
+        if self._backend == 'closure':
+            code.append((OP_CALL, self._compile_closure(tree)))
+            return
+
+        # 二項演算子
+        operators = {
+            'greater': OP_GT, 
+            'greater_equal': OP_GE, 
+            'less': OP_LT, 
+            'less_equal': OP_LE, 
+            'equal': OP_EQ, 
+            'not_equal': OP_NE, 
+            'addition': OP_ADD, 
+            'subtraction': OP_SUB, 
+            'multiply': OP_MUL, 
+            'division': OP_DIV, 
+        }
+
+        # トークン
+        if isinstance(tree, Token):
+            if tree.type == 'NUMBER':
+                code.append((OP_PUSH, self._int16(tree.value)))
+            elif tree.type == 'VARIABLE':
+                code.append((OP_LOAD, self._slot(tree)))
+
+        # 二項演算
+        elif tree.data in operators:
+            self._compile_expression(tree.children[0], code)
+            self._compile_expression(tree.children[1], code)
+            code.append((operators[tree.data], None))
+
+        # 単項マイナス
+        elif tree.data == 'negative':
+            self._compile_expression(tree.children[0], code)
+            code.append((OP_NEG, None))
+
+        # 配列
+        elif tree.data == 'array':
+            self._compile_expression(tree.children[0], code)
+            code.append((OP_ALOAD, None))
+
+        # ABS
+        elif tree.data == 'function_abs':
+            self._compile_expression(tree.children[0], code)
+            code.append((OP_ABS, None))
+
+        # RND
+        elif tree.data == 'function_rnd':
+            self._compile_expression(tree.children[0], code)
+            code.append((OP_RND, None))
+
+        # expression, sum, product, atom, positive, factor
+        else:
+            self._compile_expression(tree.children[0], code)
+
+    # 式をクロージャにコンパイルする
+    def _compile_closure(self, tree):
+
+        # トークン
+        if isinstance(tree, Token):
+            if tree.type == 'NUMBER':
+                value = self._int16(tree.value)
+                return lambda: value
+            else:
+                slots = self._slots
+                index = self._slot(tree)
+                return lambda: slots[index]
+
+        # 単項演算
+        if tree.data in ('negative', 'array', 'function_abs', 'function_rnd'):
+            operand = self._compile_closure(tree.children[0])
+            if tree.data == 'negative':
+                return lambda: ((-operand() + 0x8000) & 0xffff) - 0x8000
+            elif tree.data == 'array':
+                array = self._array
+                return lambda: array[operand() & 0xffff]
+            elif tree.data == 'function_abs':
+                return lambda: ((abs(operand()) + 0x8000) & 0xffff) - 0x8000
+            else:
+                randint = self._random.randint
+                return lambda: randint(1, operand())
+
+        # expression, sum, product, atom, positive, factor
+        if len(tree.children) == 1:
+            return self._compile_closure(tree.children[0])
+
+        # 二項演算
+        left = self._compile_closure(tree.children[0])
+        right = self._compile_closure(tree.children[1])
+        if tree.data == 'addition':
+            return lambda: ((left() + right() + 0x8000) & 0xffff) - 0x8000
+        elif tree.data == 'subtraction':
+            return lambda: ((left() - right() + 0x8000) & 0xffff) - 0x8000
+        elif tree.data == 'multiply':
+            return lambda: ((left() * right() + 0x8000) & 0xffff) - 0x8000
+        elif tree.data == 'division':
+            return lambda: ((int(left() / right()) + 0x8000) & 0xffff) - 0x8000
+        elif tree.data == 'greater':
+            return lambda: 1 if left() > right() else 0
+        elif tree.data == 'greater_equal':
+            return lambda: 1 if left() >= right() else 0
+        elif tree.data == 'less':
+            return lambda: 1 if left() < right() else 0
+        elif tree.data == 'less_equal':
+            return lambda: 1 if left() <= right() else 0
+        elif tree.data == 'equal':
+            return lambda: 1 if left() == right() else 0
+        else:
+            return lambda: 1 if left() != right() else 0
+
+    # Python のコードにコンパイルする
+    def _compile_python(self):
+
+        # ソースの生成
+        source = self._generate()
+
+        # ソースの出力
+        filename = '<tinybasic>'
+        if self._dump is not None:
+            with open(self._dump, 'w', encoding='UTF-8') as file:
+                file.write(source)
+            filename = self._dump
+
+        # ソースの実行
+        namespace = dict()
+        exec(compile(source, filename, 'exec'), namespace)
+        self._program = namespace['execute']
+
+    # プログラムから Python のソースを生成する
+    def _generate(self):
+
+        # 変数の収集
+        names = set()
+        for tree in self._statements:
+            for token in tree.scan_values(lambda value: isinstance(value, Token) and value.type == 'VARIABLE'):
+                names.add(token.value.upper())
+        names = sorted(names)
+
+        # ヘッダ
+        lines = [
+            f'# {self._path} から生成',
+            '#',
+            'import sys',
+            'from tinybasic import ForFrame',
+            '',
+            '',
+            '# 行番号から PC への変換表',
+            '#',
+            f'LINES = {self._targets!r}',
+            '',
+            '',
+            '# プログラムを実行する',
+            '#',
+            'def execute(tb, pc, budget):',
+            '',
+            '    # 状態の取得',
+            '    slots = tb._slots',
+        ]
+        for name in names:
+            lines.append(f"    {name} = slots[{ord(name) - ord('A')}]")
+        lines.extend([
+            '    array = tb._array',
+            '    gosubs = tb._gosubs',
+            '    fors = tb._fors',
+            '    out = tb._print',
+            '    newline = tb._newline',
+            '    randint = tb._random.randint',
+            '    key = None',
+            '',
+            '    # ディスパッチループ',
+            '    try:',
+            '        while pc >= 0:',
+        ])
+
+        # 行毎のブロックの作成
+        blocks = list()
+        for pc, position in enumerate(self._positions):
+            if position[1] == 0:
+                blocks.append([pc, pc])
+            else:
+                blocks[-1][1] = pc
+
+        # 行のディスパッチ
+        self._generate_dispatch(blocks, lines, 3)
+
+        # フッタ（エラーでは止めて、そこまでに使った予算を返す）
+        lines.extend([
+            '',
+            '    # エラー',
+            '    except Exception as e:',
+            "        sys.stderr.write(f'{e}\\n')",
+            '        pc = -1',
+            '',
+            '    # 状態の保存',
+            '    finally:',
+            '        pass',
+        ])
+        for name in names:
+            lines.append(f"        slots[{ord(name) - ord('A')}] = {name}")
+        lines.extend([
+            '',
+            '    # 終了',
+            '    return pc, key, budget',
+            '',
+        ])
+        return '\n'.join(lines)
+
+    # 行を二分探索でディスパッチするコードを生成する
+    def _generate_dispatch(self, blocks, lines, depth):
+        indent = '    ' * depth
+        if len(blocks) > 1:
+            middle = len(blocks) // 2
+            lines.append(f'{indent}if pc < {blocks[middle][0]}:')
+            self._generate_dispatch(blocks[:middle], lines, depth + 1)
+            lines.append(f'{indent}else:')
+            self._generate_dispatch(blocks[middle:], lines, depth + 1)
+        elif len(blocks) == 1:
+            first, last = blocks[0]
+            number = self._positions[first][0]
+            lines.append(f'{indent}# {number} {self._lines[number]}' if number in self._lines else f'{indent}# END')
+            for pc in range(first, last + 1):
+                lines.append(f'{indent}if pc <= {pc}:')
+                lines.append(f'{indent}    if budget <= 0:')
+                lines.append(f'{indent}        pc = {pc}')
+                lines.append(f'{indent}        break')
+                lines.append(f'{indent}    budget = budget - 1')
+                self._generate_statement(self._statements[pc].children[0], pc, lines, depth + 1)
+            lines.append(f'{indent}pc = {last + 1}')
+            lines.append(f'{indent}continue')
+
+    # ステートメントのコードを生成する
+    def _generate_statement(self, tree, pc, lines, depth):
+        indent = '    ' * depth
+        follow = pc + 1
+
+        # LET
+        if tree.data == 'command_let':
+            for let in tree.children:
+                target = let.children[0]
+                if isinstance(target, Token):
+                    lines.append(f'{indent}{target.value.upper()} = {self._generate_expression(let.children[1])}')
+                else:
+                    lines.append(f'{indent}_a = {self._generate_expression(target.children[0])}')
+                    lines.append(f'{indent}array[_a & 65535] = {self._generate_expression(let.children[1])}')
+
+        # PRINT
+        elif tree.data == 'command_print':
+            digit = 6
+            cr = True
+            for element in tree.children:
+                if isinstance(element, Tree):
+                    lines.append(f"{indent}out(format({self._generate_expression(element)}, '{digit}d'))")
+                elif element.type == 'STRING':
+                    lines.append(f'{indent}out({self._unquote(element.value)!r})')
+                elif element.type == 'DIGIT':
+                    digit = self._int16(element.value[1:])
+                elif element.type == 'COMMA':
+                    cr = False
+            if cr:
+                lines.append(f'{indent}newline()')
+
+        # INPUT
+        elif tree.data == 'command_input':
+            prompt = tree.children[0].children
+            if len(prompt) > 1:
+                for i in range(len(prompt) - 1):
+                    lines.append(f'{indent}out({self._unquote(prompt[i].value)!r})')
+            else:
+                lines.append(f'{indent}out({prompt[0].value.upper()!r})')
+            lines.append(f"{indent}out(':')")
+            lines.append(f'{indent}pc = {pc}')
+            lines.append(f'{indent}key = {prompt[len(prompt) - 1].value.upper()!r}')
+            lines.append(f'{indent}break')
+
+        # IF
+        elif tree.data == 'command_if':
+            lines.append(f'{indent}if {self._generate_expression(tree.children[0])} == 0:')
+            lines.append(f'{indent}    pc = {self._elses[pc]}')
+            lines.append(f'{indent}    continue')
+            if len(tree.children) > 1:
+                self._generate_statement(tree.children[1].children[0], pc, lines, depth)
+
+        # GOTO
+        elif tree.data == 'command_goto':
+            lines.append(f'{indent}pc = {self._generate_target(tree.children[0])}')
+            lines.append(f'{indent}continue')
+
+        # GOSUB
+        elif tree.data == 'command_gosub':
+            lines.append(f'{indent}gosubs.append({follow})')
+            lines.append(f'{indent}pc = {self._generate_target(tree.children[0])}')
+            lines.append(f'{indent}continue')
+
+        # RETURN
+        elif tree.data == 'command_return':
+            lines.append(f'{indent}pc = gosubs.pop()')
+            lines.append(f'{indent}continue')
+
+        # FOR
+        elif tree.data == 'command_for':
+            variable = tree.children[0].value.upper()
+            lines.append(f'{indent}_a = {self._generate_expression(tree.children[1])}')
+            lines.append(f'{indent}_b = {self._generate_expression(tree.children[2])}')
+            lines.append(f'{indent}_c = {self._generate_expression(tree.children[3]) if len(tree.children) >= 4 else 1}')
+            lines.append(f'{indent}{variable} = _a')
+            lines.append(f'{indent}fors.append(ForFrame({follow}, {self._slot(tree.children[0])}, _b, _c))')
+
+        # NEXT
+        elif tree.data == 'command_next':
+            variable = tree.children[0].value.upper()
+            lines.append(f'{indent}_a = fors[-1] if len(fors) > 0 else None')
+            lines.append(f'{indent}if _a is None or _a.pc != {self._bind_next(pc)}:')
+            lines.append(f'{indent}    while len(fors) > 0 and fors[-1].slot != {self._slot(tree.children[0])}:')
+            lines.append(f'{indent}        fors.pop()')
+            lines.append(f'{indent}    _a = fors[-1] if len(fors) > 0 else None')
+            lines.append(f'{indent}if _a is not None:')
+            lines.append(f'{indent}    {variable} = (({variable} + _a.step + 32768) & 65535) - 32768')
+            lines.append(f'{indent}    if (_a.step > 0 and {variable} <= _a.limit) or (_a.step < 0 and {variable} >= _a.limit):')
+            lines.append(f'{indent}        pc = _a.pc')
+            lines.append(f'{indent}        continue')
+
+        # STOP
+        elif tree.data == 'command_stop':
+            lines.append(f'{indent}pc = -1')
+            lines.append(f'{indent}break')
+
+    # 飛び先の PC を求めるコードを生成する
+    def _generate_target(self, tree):
+        target = self._generate_expression(tree)
+        if re.match(r'^-?\d+$', target) is not None and self._int16(target) in self._targets:
+            return str(self._targets[self._int16(target)])
+        return f'LINES[{target}]'
+
+    # 式のコードを生成する
+    def _generate_expression(self, tree):
+
+        # 二項演算子
+        operators = {
+            'greater': '({0} > {1}) * 1', 
+            'greater_equal': '({0} >= {1}) * 1', 
+            'less': '({0} < {1}) * 1', 
+            'less_equal': '({0} <= {1}) * 1', 
+            'equal': '({0} == {1}) * 1', 
+            'not_equal': '({0} != {1}) * 1', 
+            'addition': '(({0} + {1} + 32768) & 65535) - 32768', 
+            'subtraction': '(({0} - {1} + 32768) & 65535) - 32768', 
+            'multiply': '(({0} * {1} + 32768) & 65535) - 32768', 
+            'division': '((int({0} / {1}) + 32768) & 65535) - 32768', 
+        }
+
+        # トークン
+        if isinstance(tree, Token):
+            if tree.type == 'NUMBER':
+                return str(self._int16(tree.value))
+            return tree.value.upper()
+
+        # 二項演算
+        if tree.data in operators:
+            left = self._generate_expression(tree.children[0])
+            right = self._generate_expression(tree.children[1])
+            return '(' + operators[tree.data].format(left, right) + ')'
+
+        # 単項マイナス
+        if tree.data == 'negative':
+            operand = self._generate_expression(tree.children[0])
+            if re.match(r'^\d+$', operand) is not None:
+                return str(self._int16(-int(operand)))
+            return f'(((-{operand} + 32768) & 65535) - 32768)'
+
+        # 配列
+        if tree.data == 'array':
+            return f'array[({self._generate_expression(tree.children[0])}) & 65535]'
+
+        # ABS
+        if tree.data == 'function_abs':
+            return f'(((abs({self._generate_expression(tree.children[0])}) + 32768) & 65535) - 32768)'
+
+        # RND
+        if tree.data == 'function_rnd':
+            return f'randint(1, {self._generate_expression(tree.children[0])})'
+
+        # expression, sum, product, atom, positive, factor
+        return self._generate_expression(tree.children[0])
+
+    # pc から実行するジェネレータを作る
+    # 実行の前に (pc, None) を渡して次の予算（None なら前と同じ）を受け取り、
+    # 再生されない INPUT では出力を書き出して (pc, 変数名) を渡し、値（None なら同じ INPUT を繰り返す）を受け取る
+    def interpret(self, pc, budget = 0x10000):
+        while pc >= 0:
+            budget = (yield pc, None) or budget
+            pc, key = self._run(pc, budget)
+            if key is not None:
+                value = self._replay(pc, key)
+                if value is None:
+                    self._output.flush()
+                while value is None:
+                    value = yield pc, key
+                self._accept_input(pc, key, value)
+                self._newline()
+                pc = pc + 1
 
     # 実行する
     def _execute(self):
 
         # 実行の設定
-        number = self._start
-        statement = 0
+        machine = self.interpret(self._targets.get(self._start, -1))
+        value = None
 
-        # メインループ
-        while number > 0:
-            number, statement, key = self._process(number, statement)
-            if key is not None:
+        # メインループ（INPUT では 1 行を読んで値を返す）
+        try:
+            while True:
+                pc, key = machine.send(value)
                 value = None
-                while value is None:
-                    string = input()
-                    if len(string) > 0:
-                        if string[0].isdecimal():
-                            value = self._int16(string)
-                        elif string[0].isalpha():
-                            key = string[0].upper()
-                            if key not in self._variables:
-                                self._variables[key] = 0
-                            value = self._variables[key]
+                if key is not None:
+                    string = self._readline()
+                    if string is None:
+                        return True
+                    value = self._parse_input(string)
                     if value is None:
                         self._newline()
-                self._variables[key] = value
-                self._newline()
-                number, statement = self._get_next_statement(number, statement)
-
-    # ステートメントを処理する
-    def _process(self, number, statement):
+        except StopIteration:
+            pass
 
-        # Visitor の作成
-        result = None
-        self._log(f'{number}:{statement} >>>')
+        # 終了
+        return True
 
-        # ステートメントの実行
+    # 1 行を入力する（入力の終わりでは None）
+    def _readline(self):
         try:
-            result = self.transform(self._trees[number][statement])
+            return input()
+        except EOFError:
+            return None
+
+    # 記録された INPUT の値を取得する（再生しないときは None）
+    def _replay(self, pc, key):
+        if self._replayer is None:
+            return None
+        line, statement = self._positions[pc]
+        return self._replayer.read(line, statement, key)
+
+    # INPUT の値を変数に設定する（再生、艦長、フロントエンドから来た値も 16bits 整数に丸めてから記録する）
+    def _accept_input(self, pc, key, value):
+        value = self._int16(value)
+        if self._recorder is not None:
+            line, statement = self._positions[pc]
+            self._recorder.write(line, statement, key, value)
+        self._set_variable(key, value)
+
+    # 入力された文字列を値にする
+    def _parse_input(self, string):
+        if len(string) > 0:
+            if string[0].isdecimal():
+                return self._int16(re.match(r'\d+', string).group())
+            elif string[0].upper() in self._variables:
+                return self._variables[string[0].upper()]
+        return None
+
+    # 最大 budget 個のステートメントを実行する
+    def _run(self, pc, budget):
+
+        # トレースもプロファイラも無効ならバックエンドをそのまま呼ぶ
+        if self._tracer is None and self._profiler is None:
+            pc, key, rest = self._runner(pc, budget)
+            self._executed = self._executed + budget - rest
+            return pc, key
+
+        # 1 ステートメントずつトレース、計測しながら実行
+        key = None
+        while pc >= 0 and budget > 0 and key is None:
+            number, statement = self._positions[pc]
+            if self._tracer is not None:
+                self._trace('statement', pc = pc, line = number, statement = statement)
+            if self._profiler is None:
+                pc, key, rest = self._runner(pc, 1)
+            else:
+                depth = len(self._gosubs)
+                start = time.perf_counter()
+                pc, key, rest = self._runner(pc, 1)
+                self._profiler.record(number, statement, time.perf_counter() - start)
+                if len(self._gosubs) > depth and pc >= 0:
+                    self._profiler.call(self._positions[pc][0])
+            self._executed = self._executed + 1 - rest
+            budget = budget - 1
+        if self._tracer is not None:
+            if key is not None:
+                self._trace('input', pc = pc, variable = key)
+            elif pc < 0:
+                self._trace('stop', pc = pc)
+        return pc, key
+
+    # Transformer で実行する
+    def _run_transformer(self, pc, budget):
+        key = None
+        while pc >= 0 and budget > 0 and key is None:
+            pc, key = self._process(pc)
+            budget = budget - 1
+        return pc, key, budget
+
+    # 生成コードで実行する
+    def _run_program(self, pc, budget):
+        if pc < 0:
+            return pc, None, budget
+        return self._program(self, pc, budget)
+
+    # バイトコードを VM で実行する
+    def _run_vm(self, pc, budget):
+
+        # 実行の準備
+        codes = self._codes
+        elses = self._elses
+        targets = self._targets
+        gosubs = self._gosubs
+        fors = self._fors
+        slots = self._slots
+        array = self._array
+        stack = list()
+        push = stack.append
+        pop = stack.pop
+        randint = self._random.randint
+
+        # VM のループ
+        try:
+            while pc >= 0 and budget > 0:
+                budget = budget - 1
+                for op, arg in codes[pc]:
+                    if op == OP_CALL:
+                        push(arg())
+                    elif op == OP_PUSH:
+                        push(arg)
+                    elif op == OP_LOAD:
+                        push(slots[arg])
+                    elif op == OP_ALOAD:
+                        push(array[pop() & 0xffff])
+                    elif op == OP_STORE:
+                        slots[arg] = pop()
+                    elif op == OP_ASTORE:
+                        value = pop()
+                        array[pop() & 0xffff] = value
+                    elif op <= OP_NE:
+                        right = pop()
+                        left = pop()
+                        if op == OP_ADD:
+                            push(((left + right + 0x8000) & 0xffff) - 0x8000)
+                        elif op == OP_SUB:
+                            push(((left - right + 0x8000) & 0xffff) - 0x8000)
+                        elif op == OP_MUL:
+                            push(((left * right + 0x8000) & 0xffff) - 0x8000)
+                        elif op == OP_DIV:
+                            push(((int(left / right) + 0x8000) & 0xffff) - 0x8000)
+                        elif op == OP_GT:
+                            push(1 if left > right else 0)
+                        elif op == OP_GE:
+                            push(1 if left >= right else 0)
+                        elif op == OP_LT:
+                            push(1 if left < right else 0)
+                        elif op == OP_LE:
+                            push(1 if left <= right else 0)
+                        elif op == OP_EQ:
+                            push(1 if left == right else 0)
+                        else:
+                            push(1 if left != right else 0)
+                    elif op == OP_NEG:
+                        push(((-pop() + 0x8000) & 0xffff) - 0x8000)
+                    elif op == OP_ABS:
+                        push(((abs(pop()) + 0x8000) & 0xffff) - 0x8000)
+                    elif op == OP_RND:
+                        push(randint(1, pop()))
+                    elif op == OP_PRINT_STRING:
+                        self._print(arg)
+                    elif op == OP_PRINT_NUMBER:
+                        self._print(f'{pop():{arg}d}')
+                    elif op == OP_NEWLINE:
+                        self._newline()
+                    elif op == OP_IF:
+                        if pop() == 0:
+                            pc = elses[pc]
+                            break
+                    elif op == OP_GOTO:
+                        pc = targets[pop()]
+                        break
+                    elif op == OP_GOSUB:
+                        gosubs.append(pc + 1)
+                        pc = targets[pop()]
+                        break
+                    elif op == OP_RETURN:
+                        pc = gosubs.pop()
+                        break
+                    elif op == OP_FOR:
+                        step = pop()
+                        limit = pop()
+                        slots[arg] = pop()
+                        pc = pc + 1
+                        fors.append(ForFrame(pc, arg, limit, step))
+                        break
+                    elif op == OP_NEXT:
+                        slot, body = arg
+                        loop = fors[-1] if len(fors) > 0 else None
+                        if loop is None or loop.pc != body:
+                            while len(fors) > 0 and fors[-1].slot != slot:
+                                fors.pop()
+                            loop = fors[-1] if len(fors) > 0 else None
+                        if loop is not None:
+                            step = loop.step
+                            value = ((slots[slot] + step + 0x8000) & 0xffff) - 0x8000
+                            slots[slot] = value
+                            if (step > 0 and value <= loop.limit) or (step < 0 and value >= loop.limit):
+                                pc = loop.pc
+                                break
+                        pc = pc + 1
+                        break
+                    elif op == OP_STOP:
+                        pc = -1
+                        break
+                    elif op == OP_INPUT:
+                        return pc, arg, budget
+                else:
+                    pc = pc + 1
 
         # 例外
         except Exception as e:
-            sys.stderr.write('f{e}\n')
-            return 0, 0, None
+            sys.stderr.write(f'{e}\n')
+            return -1, None, budget
 
-        # 実行の完了
-        finally:
+        # 終了
+        return pc, None, budget
+
+    # ステートメントを処理する
+    def _process(self, pc):
+
+        # ステートメントの実行
+        try:
+            result = self.transform(self._statements[pc])
+
+            # 次の PC（RETURN の空のスタックや無い行もエラーにする）
+            key = None
             if result[0] == 'else':
-                if number in self._nexts:
-                    number = self._nexts[number]
-                    statement = 0
-                else:
-                    number = 0
+                pc = self._elses[pc]
             elif result[0] == 'goto':
-                number = result[1]
-                statement = 0
+                pc = self._targets[result[1]]
             elif result[0] == 'gosub':
-                number, statement = self._get_next_statement(number, statement)
-                self._gosubs.append([number, statement])
-                number = result[1]
-                statement = 0
+                self._gosubs.append(pc + 1)
+                pc = self._targets[result[1]]
             elif result[0] == 'return':
-                params = self._gosubs.pop()
-                number = params[0]
-                statement = params[1]
+                pc = self._gosubs.pop()
             elif result[0] == 'for':
-                number, statement = self._get_next_statement(number, statement)
-                self._fors.append([number, statement, result[1], result[2], result[3]])
+                pc = pc + 1
+                self._fors.append(ForFrame(pc, result[1], result[2], result[3]))
             elif result[0] == 'next':
-                if result[1] is not None:
-                    number = result[1][0]
-                    statement = result[1][1]
-                else:
-                    number, statement = self._get_next_statement(number, statement)
+                pc = result[1] if result[1] is not None else pc + 1
             elif result[0] == 'stop':
-                number = 0
+                pc = -1
             elif result[0] == 'input':
-                pass
+                key = result[1]
             else:
-                number, statement = self._get_next_statement(number, statement)
+                pc = pc + 1
+
+        # 例外
+        except Exception as e:
+            sys.stderr.write(f'{e}\n')
+            return -1, None
+
+        # 実行の完了
+        finally:
+            pass
 
         # 終了
-        return number, statement, result[1] if result[0] == 'input' else None
+        return pc, key
 
     # Transformer
 
     # statement
     def statement(self, tree):
-        self._log(f'statement: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'statement', value = tree)
         return tree[0]
 
     # command_let
     def command_let(self, tree):
-        self._log(f'command_let: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'command_let', value = tree)
         return [None, None]
 
     # let
     def let(self, tree):
-        self._log(f'let: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'let', value = tree)
         if tree[0][0] == 'VARIABLE':
-            self._variables[tree[0][1]] = tree[1][1]
+            self._slots[tree[0][1]] = tree[1][1]
         elif tree[0][0] == 'array':
-            self._array[tree[0][1][1]] = tree[1][1]
+            self._array[tree[0][1][1] & 0xffff] = tree[1][1]
         return tree[1][1]
 
     # command_print
     def command_print(self, tree):
-        self._log(f'command_print {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'command_print', value = tree)
         digit = 6
         cr = True
         for element in tree:
@@ -357,255 +1725,305 @@ class TinyBasic(Transformer):
 
     # command_input
     def command_input(self, tree):
-        self._log(f'command_input {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'command_input', value = tree)
         prompt = tree[0]
+        key = chr(ord('A') + prompt[len(prompt) - 1][1])
         if len(prompt) > 1:
             for i in range(len(prompt) - 1):
                 self._print(prompt[i][1])
         else:
-            self._print(prompt[0][1])
+            self._print(key)
         self._print(':')
-        return ['input', prompt[len(prompt) - 1][1]]
+        return ['input', key]
 
     # command_if
     def command_if(self, tree):
-        self._log(f'command_if {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'command_if', value = tree)
         return [None, None] if tree[0][1] != 0 else ['else', None]
     
     # command_goto
     def command_goto(self, tree):
-        self._log(f'command_goto {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'command_goto', value = tree)
         return ['goto', tree[0][1]]
     
     # command_gosub
     def command_gosub(self, tree):
-        self._log(f'command_gosub {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'command_gosub', value = tree)
         return ['gosub', tree[0][1]]
     
     # command_return
     def command_return(self, tree):
-        self._log(f'command_return {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'command_return', value = tree)
         return ['return', None]
     
     # command_for
     def command_for(self, tree):
-        self._log(f'command_for {tree}')
-        self._variables[tree[0][1]] = tree[1][1]
+        if self._tracer is not None:
+            self._trace('node', rule = 'command_for', value = tree)
+        self._slots[tree[0][1]] = tree[1][1]
         return ['for', tree[0][1], tree[2][1], tree[3][1] if len(tree) >= 4 else 1]
     
     # command_next
     def command_next(self, tree):
-        self._log(f'command_next {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'command_next', value = tree)
         i = len(self._fors) - 1
-        while i >= 0 and self._fors[i][2] != tree[0][1]:
+        while i >= 0 and self._fors[i].slot != tree[0][1]:
             self._fors.pop()
             i = i - 1
         result = None
         if i >= 0:
-            v = self._fors[i][2]
-            self._variables[v] = self._int16(self._int16(self._variables[v] + self._fors[i][4]))
-            if (self._fors[i][4] > 0 and self._variables[v] <= self._fors[i][3]) or (self._fors[i][4] < 0 and self._variables[v] >= self._fors[i][3]):
-                result = [self._fors[i][0], self._fors[i][1]]
+            loop = self._fors[i]
+            v = loop.slot
+            self._slots[v] = self._int16(self._slots[v] + loop.step)
+            if (loop.step > 0 and self._slots[v] <= loop.limit) or (loop.step < 0 and self._slots[v] >= loop.limit):
+                result = loop.pc
         return ['next', result]
     
     # command_stop
     def command_stop(self, tree):
-        self._log(f'command_stop: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'command_stop', value = tree)
         return ['stop', 0]
 
     # function_abs
     def function_abs(self, tree):
-        self._log(f'function_abs: {tree}')
-        return ['NUMBER', abs(tree[0][1])]
+        if self._tracer is not None:
+            self._trace('node', rule = 'function_abs', value = tree)
+        return ['NUMBER', self._int16(abs(tree[0][1]))]
 
     # function_rnd
     def function_rnd(self, tree):
-        self._log(f'function_rnd: {tree}')
-        return ['NUMBER', random.randint(1, tree[0][1])]
+        if self._tracer is not None:
+            self._trace('node', rule = 'function_rnd', value = tree)
+        return ['NUMBER', self._random.randint(1, tree[0][1])]
 
     # prompt
     def prompt(self, tree):
-        self._log(f'prompt: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'prompt', value = tree)
         return tree
 
     # expression
     def expression(self, tree):
-        self._log(f'expression: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'expression', value = tree)
         return tree[0]
 
     # greater
     def greater(self, tree):
-        self._log(f'greater: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'greater', value = tree)
         return ['NUMBER', 1 if tree[0] > tree[1] else 0]
         
     # greater_equal
     def greater_equal(self, tree):
-        self._log(f'greater: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'greater_equal', value = tree)
         return ['NUMBER', 1 if tree[0] >= tree[1] else 0]
         
     # less
     def less(self, tree):
-        self._log(f'less: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'less', value = tree)
         return ['NUMBER', 1 if tree[0] < tree[1] else 0]
         
     # less_equal
     def less_equal(self, tree):
-        self._log(f'less_equal: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'less_equal', value = tree)
         return ['NUMBER', 1 if tree[0] <= tree[1] else 0]
         
     # equal
     def equal(self, tree):
-        self._log(f'equal: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'equal', value = tree)
         return ['NUMBER', 1 if tree[0] == tree[1] else 0]
         
     # not_equal
     def not_equal(self, tree):
-        self._log(f'not_equal: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'not_equal', value = tree)
         return ['NUMBER', 1 if tree[0] != tree[1] else 0]
         
     # sum
     def sum(self, tree):
-        self._log(f'sum: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'sum', value = tree)
         return tree[0]
 
     # addition
     def addition(self, tree):
-        self._log(f'addition: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'addition', value = tree)
         return ['NUMBER', self._int16(tree[0][1] + tree[1][1])]
 
     # subtraction
     def subtraction(self, tree):
-        self._log(f'subtraction: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'subtraction', value = tree)
         return ['NUMBER', self._int16(tree[0][1] - tree[1][1])]
 
     # product
     def product(self, tree):
-        self._log(f'product: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'product', value = tree)
         return tree[0]
 
     # multiply
     def multiply(self, tree):
-        self._log(f'multiply: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'multiply', value = tree)
         return ['NUMBER', self._int16(tree[0][1] * tree[1][1])]
 
     # division
     def division(self, tree):
-        self._log(f'division: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'division', value = tree)
         return ['NUMBER', self._int16(tree[0][1] / tree[1][1])]
 
     # atom
     def atom(self, tree):
-        self._log(f'atom: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'atom', value = tree)
         return tree[0]
 
     # positive
     def positive(self, tree):
-        self._log(f'positive: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'positive', value = tree)
         # return ['NUMBER', self._int16(tree[0][1])]
         return tree[0]
 
     # negative
     def negative(self, tree):
-        self._log(f'negative: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'negative', value = tree)
         return ['NUMBER', self._int16(-tree[0][1])]
 
     # factor
     def factor(self, tree):
-        self._log(f'factor: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'factor', value = tree)
         result = 0
         if tree[0][0] == 'NUMBER':
             result = tree[0][1]
         elif tree[0][0] == 'VARIABLE':
-            key = tree[0][1]
-            if key not in self._variables:
-                self._variables[key] = 0
-            result = self._variables[key]
+            result = self._slots[tree[0][1]]
         elif tree[0][0] == 'array':
-            key = tree[0][1][1]
-            if key not in self._array:
-                self._array[key] = 0
-            result = self._array[key]
+            result = self._array[tree[0][1][1] & 0xffff]
         return ['NUMBER', result]
 
     # VARIABLE
     def VARIABLE(self, tree):
-        self._log(f'VARIABLE: {tree}')
-        return ['VARIABLE', tree[0].upper()]
+        if self._tracer is not None:
+            self._trace('node', rule = 'VARIABLE', value = tree)
+        return ['VARIABLE', self._slot(tree)]
 
     # array
     def array(self, tree):
-        self._log(f'array: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'array', value = tree)
         return ['array', tree[0]]
 
     # NUMBER
     def NUMBER(self, tree):
-        self._log(f'NUMBER: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'NUMBER', value = tree)
         return ['NUMBER', self._int16(tree.value)]
 
     # STRING
     def STRING(self, tree):
-        self._log(f'STRING: {tree}')
-        tail = len(tree.value) - 1
-        if tree.value[0] == "\"":
-            if tree.value[tail] == "\"":
-                tail = tail - 1
-        elif tree.value[0] == "'":
-            if tree.value[tail] == "'":
-                tail = tail - 1
-        return ['STRING', tree.value[1:tail + 1]]
+        if self._tracer is not None:
+            self._trace('node', rule = 'STRING', value = tree)
+        return ['STRING', self._unquote(tree.value)]
 
     # DIGIT
     def DIGIT(self, tree):
-        self._log(f'DIGIT: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'DIGIT', value = tree)
         return ['DIGIT', self._int16(tree.value[1:])]
 
     # COMMA
     def COMMA(self, tree):
-        self._log(f'COMMA: {tree}')
+        if self._tracer is not None:
+            self._trace('node', rule = 'COMMA', value = tree)
         return ['COMMA', 0]
 
+    # 変数のスロットの番号を取得する
+    def _slot(self, token):
+        return ord(token.value.upper()) - ord('A')
+
+    # 変数に値を 16bits 整数にして設定する
+    def _set_variable(self, key, value):
+        self._slots[ord(key) - ord('A')] = self._int16(value)
+
+    # 文字列の引用符を外す
+    def _unquote(self, value):
+        tail = len(value) - 1
+        if value[0] == "\"":
+            if value[tail] == "\"":
+                tail = tail - 1
+        elif value[0] == "'":
+            if value[tail] == "'":
+                tail = tail - 1
+        return value[1:tail + 1]
+
     # 16bits 整数を取得する
     def _int16(self, value):
         result = value if type(value) is int else int(value)
         result = result & 0xffff
         return result if result < 0x8000 else result - 0x10000
 
-    # 次のステートメントを取得する
-    def _get_next_statement(self, number, statement):
-        statement = statement + 1
-        if statement not in self._trees[number]:
-            if number in self._nexts:
-                number = self._nexts[number]
-                statement = 0
-            else:
-                number = 0
-        else:
-            pass
-        return number, statement
-
     # 文字列を出力する
     def _print(self, string):
-        print(string, end = '')
+        self._output.write(string)
 
     # 改行する
     def _newline(self):
-        print('')
+        self._output.write('\n')
 
-    # ログを出力する
-    def _log(self, *args):
-        if self._debug:
-            for value in args:
-                print(value, end = '')
-            print('')
+    # トレースを出力する
+    def _trace(self, event, **fields):
+        self._tracer.write(dict(event = event, **fields))
 
 # アプリケーションのエントリポイント
 #
 if __name__ == '__main__':
 
     # 引数の取得
-    if len(sys.argv) < 2:
-        sys.stderr.write('error - no file.\n')
-        exit()
-    
+    parser = argparse.ArgumentParser(description = 'Tiny BASIC')
+    parser.add_argument('path', help = 'BASIC program')
+    parser.add_argument('--backend', default = 'bytecode', choices = BACKENDS)
+    parser.add_argument('--dump', default = None, help = 'write the generated Python module (python backend)')
+    parser.add_argument('--array-size', type = int, default = 1024, help = 'number of @() elements')
+    parser.add_argument('--trace', default = None, help = "write a trace as JSON Lines to a file, or as text to stderr with '-'")
+    parser.add_argument('--seed', type = int, default = None, help = 'seed for RND')
+    parser.add_argument('--record', default = None, help = 'record the INPUT values and the seed to a JSON file')
+    parser.add_argument('--replay', default = None, help = 'feed the INPUT values recorded with --record back')
+    parser.add_argument('--profile', default = None, help = "print per-line counts and times to stderr and write them as JSON to a file, or only print with '-'")
+    args = parser.parse_args()
+
+    # トレースの出力先
+    tracer = None
+    if args.trace == '-':
+        tracer = TextTraceSink()
+    elif args.trace is not None:
+        tracer = JsonTraceSink(args.trace)
+
+    # プロファイラ
+    profiler = None
+    if args.profile is not None:
+        profiler = Profiler(None if args.profile == '-' else args.profile)
+
+    # INPUT の記録と再生
+    recorder = InputRecorder(args.record) if args.record is not None else None
+    replayer = InputReplayer(args.replay) if args.replay is not None else None
+
     # Tiny BASIC の実行
-    TinyBasic().run(sys.argv[1])
+    TinyBasic(backend = args.backend, dump = args.dump, tracer = tracer, array_size = args.array_size, profiler = profiler, seed = args.seed, recorder = recorder, replayer = replayer).run(args.path)
@@ -4,20 +4,207 @@
 
 # 参照
 #
-from sys import call_tracing
+import time
+import queue
+import argparse
+import threading
+import collections
 from tinybasic import TinyBasic
+from tinybasic import Snapshot
 import pyxel
 
 
+# フレーム毎の実行時間の配分
+#
+class FrameScheduler:
+
+    # コンストラクタ（share はフレームの間隔のうち実行に使う割合の初期値）
+    def __init__(self, fps, share = 0.5):
+
+        # フレームの間隔と実行時間の予算（秒）
+        self.interval = 1 / fps
+        self.budget = self.interval * share
+        self._minimum = self.interval * 0.05
+        self._maximum = self.interval * 0.8
+
+        # 1 回の実行で進めるステートメント数
+        self._chunk = 64
+
+        # 計測
+        self._last = None
+        self._counted = 0
+        self.statements = 0
+        self.rate = 0.0
+
+    # フレームを始める（前のフレームの間隔が延びていれば予算を減らし、間に合っていれば少しずつ増やす）
+    def begin(self):
+        now = time.perf_counter()
+        if self._last is not None:
+            if now - self._last > self.interval * 1.1:
+                self.budget = max(self._minimum, self.budget * 0.8)
+            else:
+                self.budget = min(self._maximum, self.budget + self.interval * 0.01)
+        self._last = now
+
+    # 予算を使い切るか INPUT に着くまで実行のジェネレータを進める
+    def run(self, basic, machine):
+
+        # 実行（1 ステートメントの実測の時間から、残りの半分で終わる数ずつ進める）
+        start = time.perf_counter()
+        deadline = start + self.budget
+        pc, key = -1, None
+        while key is None:
+            before = basic._executed
+            now = time.perf_counter()
+            try:
+                pc, key = machine.send(self._chunk)
+            except StopIteration:
+                pc, key = -1, None
+                break
+            elapsed = time.perf_counter() - now
+            count = basic._executed - before
+            if count > 0 and elapsed > 0:
+                self._chunk = max(16, int((deadline - now - elapsed) / (elapsed / count) / 2))
+            if now + elapsed >= deadline:
+                break
+
+        # 終了
+        return pc, key
+
+    # ここまでに実行したステートメント数から、このフレームの分を計上する（毎フレーム呼び、実行しなかったフレームは 0 になる）
+    def count(self, executed):
+        self.statements = executed - self._counted
+        self._counted = executed
+        self.rate = self.rate * 0.9 + self.statements * 0.1
+
+
+# 文字セルのテキストバッファ（最下行にだけ書き込み、スクロールは行の番号を回す）
+#
+class TextBuffer:
+
+    # コンストラクタ
+    def __init__(self, columns, rows):
+
+        # 文字セル
+        self.columns = columns
+        self.rows = rows
+        self._cells = [[' '] * columns for row in range(rows)]
+
+        # 画面の先頭の行のバッファ上の位置と、最下行のカーソルの桁
+        self.top = 0
+        self.column = 0
+
+        # 描画されていない桁の範囲（バッファ上の行の位置 → [開始, 終了)）
+        self._dirty = {row: [0, columns] for row in range(rows)}
+
+    # 最下行のバッファ上の位置を取得する
+    def _bottom(self):
+        return (self.top + self.rows - 1) % self.rows
+
+    # 1 つの桁を描画されていない範囲に加える
+    def _touch(self, row, column):
+        span = self._dirty.get(row)
+        if span is None:
+            self._dirty[row] = [column, column + 1]
+        elif column < span[0]:
+            span[0] = column
+        elif column >= span[1]:
+            span[1] = column + 1
+
+    # １文字を書き込む（行末を越えたら改行する）
+    def putc(self, c):
+        row = self._bottom()
+        self._cells[row][self.column] = c
+        self._touch(row, self.column)
+        self.column = self.column + 1
+        if self.column >= self.columns:
+            self.newline()
+
+    # １文字を消す
+    def backspace(self):
+        if self.column > 0:
+            self.column = self.column - 1
+            row = self._bottom()
+            self._cells[row][self.column] = ' '
+            self._touch(row, self.column)
+
+    # 改行する（先頭の行を空けて最下行にする）
+    def newline(self):
+        self.top = (self.top + 1) % self.rows
+        row = self._bottom()
+        cells = self._cells[row]
+        for column in range(self.columns):
+            cells[column] = ' '
+        self._dirty[row] = [0, self.columns]
+        self.column = 0
+
+    # 描画されていない範囲を取り出す（バッファ上の行の位置、開始の桁、文字列）
+    def flush(self):
+        spans = [(row, start, ''.join(self._cells[row][start:end])) for row, (start, end) in self._dirty.items()]
+        self._dirty.clear()
+        return spans
+
+
+# キーボード（1 フレームに 1 度だけ読み、打たれた文字を打たれた順に溜めておく）
+#
+class Keyboard:
+
+    # コンストラクタ（limit は溜めておく文字数）
+    def __init__(self, limit = 32):
+
+        # キーと文字（ENTER は '\r'、BACKSPACE と DELETE は '\b' にする）
+        self._keys = dict()
+        for i in range(10):
+            self._keys[getattr(pyxel, f'KEY_{i}')] = str(i)
+            self._keys[getattr(pyxel, f'KEY_KP_{i}')] = str(i)
+        for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+            self._keys[getattr(pyxel, f'KEY_{c}')] = c
+        self._keys[pyxel.KEY_BACKSPACE] = '\b'
+        self._keys[pyxel.KEY_DELETE] = '\b'
+        self._keys[pyxel.KEY_RETURN] = '\r'
+        self._keys[pyxel.KEY_KP_ENTER] = '\r'
+
+        # Pyxel がフレームで打たれた順のキーを持っていなければキーを走査する（同じフレームの順序は分からない）
+        # Pyxel 1.8.5 は初期化の前に input_keys を読むと落ちるので、最初の poll で調べる
+        self._ordered = None
+
+        # 打たれた文字
+        self._buffer = collections.deque(maxlen = limit)
+
+    # 1 フレームの入力を読む（同じフレームの文字と制御キーも打たれた順に並べる）
+    def poll(self):
+        if self._ordered is None:
+            self._ordered = hasattr(pyxel, 'input_keys')
+        if self._ordered:
+            for key in pyxel.input_keys:
+                c = self._keys.get(key)
+                if c is not None:
+                    self._buffer.append(c)
+        else:
+            for key, c in self._keys.items():
+                if pyxel.btnp(key):
+                    self._buffer.append(c)
+
+    # 1 文字を取り出す
+    def read(self):
+        return self._buffer.popleft() if self._buffer else None
+
+
 # TinyTrek クラス
 #
 class TinyTrek(TinyBasic):
 
-    # コンストラクタ
-    def __init__(self):
+    # コンストラクタ（threaded ならインタプリタを別スレッドで実行する）
+    def __init__(self, threaded = False, **options):
 
         # super
-        super().__init__()
+        super().__init__(**options)
+
+        # スレッドの初期化（出力は待ち行列に積み、_update でテキストバッファに移す）
+        self._threaded = threaded
+        self._thread = None
+        self._inputs = queue.Queue()
+        self._outputs = collections.deque()
 
         # 色の初期化
         self._color_text = 9
@@ -31,15 +218,20 @@ class TinyTrek(TinyBasic):
         self._screen_size_x = 64 * self._font_size_x
         self._screen_size_y = 24 * self._font_size_y
 
-        # カーソルの初期化
-        self._cursor_x = 0
-        self._cursor_y = self._screen_size_y - self._font_size_y
+        # テキストバッファの初期化（image(0) にはバッファ上の行の順に描く）
+        self._text = TextBuffer(self._screen_size_x // self._font_size_x, self._screen_size_y // self._font_size_y)
 
         # 入力の初期化
         self._input_string = ''
+        self._keyboard = Keyboard()
+
+        # 実行速度の初期化（F1 で statements/frame を表示する）
+        self._fps = 30
+        self._scheduler = FrameScheduler(self._fps)
+        self._show_rate = False
 
         # Pyxel の初期化
-        pyxel.init(self._screen_size_x, self._screen_size_y, title = 'Tiny Trek')
+        pyxel.init(self._screen_size_x, self._screen_size_y, title = 'Tiny Trek', fps = self._fps)
         pyxel.cls(self._color_back)
         pyxel.image(0).cls(self._color_back)
 
@@ -47,183 +239,202 @@ class TinyTrek(TinyBasic):
     def _execute(self):
 
         # 実行の初期化
-        self._number = self._start
-        self._statement = 0
-        self._key = None
-        self._speed = 1000
+        pc = self._targets.get(self._start, -1)
+        if self._threaded:
+            self._pc, self._key = pc, None
+            self._thread = threading.Thread(target = self._work, args = (pc, ), daemon = True)
+            self._thread.start()
+        else:
+            self._begin(pc)
 
         # Pyxel の実行
         pyxel.run(self._update, self._draw)
 
+    # pc から実行のジェネレータを始める（別スレッドでは INPUT の待ちからやり直させる）
+    def _begin(self, pc):
+        if self._thread is not None:
+            self._pc, self._key = pc, None
+            self._input_string = ''
+            self._inputs.put(('restart', pc))
+        else:
+            self._machine = self.interpret(pc)
+            self._pc, self._key = next(self._machine, (-1, None))
+
+    # 別スレッドで実行する（INPUT では pc と変数名を置いて、値かやり直す pc が届くまで待つ）
+    def _work(self, pc):
+        command = 'restart'
+        while command == 'restart':
+            machine = self.interpret(pc)
+            value = None
+            try:
+                while True:
+                    pc, key = machine.send(value)
+                    value = None
+                    if key is not None:
+                        self._pc = pc
+                        self._key = key
+                        command, value = self._inputs.get()
+                        if command == 'restart':
+                            pc = value
+                            break
+            except StopIteration:
+                command = None
+        self._pc = -1
+
     # 1 フレームの更新を行う
     def _update(self):
 
-        # 1 回の更新
+        # キー入力の読み込み（実行中に打たれた文字も次の INPUT まで溜めておく）
+        self._keyboard.poll()
+
+        # 1 回の更新（フレームの予算の分だけ実行する、別スレッドでは実行しない）
+        self._scheduler.begin()
         if self._key is None:
-            cycle = 0
-            while cycle < self._speed and self._key is None:
-                self._number, self._statement, self._key = self._process(self._number, self._statement)
-                cycle = cycle + 1
+            if self._thread is None:
+                self._pc, self._key = self._scheduler.run(self, self._machine)
             self._input_string = ''
 
-        # キー入力
-        if self._key is not None:
-
-            # キー入力の更新
-            if self._input():
-
-                # 値の取得
-                if self._input_string[0].isdecimal():
-                    value = self._int16(self._input_string)
-                elif self._input_string[0].isalpha():
-                    key = self._input_string[0].upper()
-                    if key not in self._variables:
-                        self._variables[key] = 0
-                    value = self._variables[key]
+        # 実効のステートメント数／フレーム（INPUT を待つフレームも数える）
+        self._scheduler.count(self._executed)
 
-                # 値の設定
-                self._variables[self._key] = value
-                self._number, self._statement = self._get_next_statement(self._number, self._statement)
-                self._key = None
+        # 実行速度の表示の切り替え
+        if pyxel.btnp(pyxel.KEY_F1):
+            self._show_rate = not self._show_rate
 
-                # 改行
-                self._newline()
+        # キー入力
+        if self._key is not None:
 
-        pyxel.blt(0, 0, 0, 0, 0, self._screen_size_x, self._screen_size_y)
+            # F5 でセーブ、F9 でロード（INPUT をやり直す）
+            if pyxel.btnp(pyxel.KEY_F5):
+                self._save_game()
+            elif pyxel.btnp(pyxel.KEY_F9):
+                self._load_game()
+
+            # キー入力の更新（値を渡して実行を再開する）
+            elif self._input():
+                value = self._parse_input(self._input_string)
+                if self._thread is not None:
+                    self._key = None
+                    self._input_string = ''
+                    self._inputs.put(('value', value))
+                else:
+                    self._pc, self._key = self._machine.send(value)
+
+        # 出力をテキストバッファに移す
+        outputs = self._outputs
+        while outputs:
+            string = outputs.popleft()
+            if string == '\n':
+                self._text.newline()
+            elif string == '\b':
+                self._text.backspace()
+            else:
+                for c in string:
+                    self._text.putc(c)
+
+    # セーブファイルのパスを取得する
+    def _get_save_path(self):
+        return self._path + '.sav'
+
+    # ゲームをセーブする
+    def _save_game(self):
+        try:
+            with open(self._get_save_path(), 'wb') as file:
+                file.write(self.snapshot(self._pc).to_bytes())
+            message = 'SAVED.'
+        except Exception:
+            message = 'SAVE ERROR.'
+        self._newline()
+        self._print(message)
+        self._newline()
+        self._begin(self._pc)
+
+    # ゲームをロードする
+    def _load_game(self):
+        try:
+            with open(self._get_save_path(), 'rb') as file:
+                self._pc = self.restore(Snapshot.from_bytes(file.read()))
+            message = 'LOADED.'
+        except Exception:
+            message = 'LOAD ERROR.'
+        self._newline()
+        self._print(message)
+        self._newline()
+        self._begin(self._pc)
 
     # 1 フレームの描画を行う
     def _draw(self):
-        pass
 
-    # 文字列を出力する
+        # 変更された範囲だけを image(0) に 1 回の text で描く（Pyxel 1.8.5 では 1 文字でもグリフのアトラスからの転送より速い）
+        image = pyxel.image(0)
+        for row, start, string in self._text.flush():
+            x = start * self._font_size_x
+            y = row * self._font_size_y
+            image.rect(x, y, len(string) * self._font_size_x, self._font_size_y, self._color_back)
+            image.text(x, y, string.rstrip(), self._color_text)
+
+        # 先頭の行から順に画面へ転送する
+        y = (self._text.rows - self._text.top) * self._font_size_y
+        pyxel.blt(0, 0, 0, 0, self._text.top * self._font_size_y, self._screen_size_x, y)
+        if self._text.top > 0:
+            pyxel.blt(0, y, 0, 0, 0, self._screen_size_x, self._text.top * self._font_size_y)
+
+        # 実行速度の表示
+        if self._show_rate:
+            text = f'{self._scheduler.rate:.0f} ST/F {self._scheduler.budget * 1000:.1f} MS'
+            pyxel.rect(self._screen_size_x - len(text) * self._font_size_x, 0, len(text) * self._font_size_x, self._font_size_y, self._color_back)
+            pyxel.text(self._screen_size_x - len(text) * self._font_size_x, 0, text, self._color_text)
+
+    # 文字列を出力する（別スレッドからも呼ばれるので待ち行列に積む）
     def _print(self, string):
-
-        # １文字ずつ出力
-        for c in string:
-            self._putc(c)
-
-    # １文字を出力する
-    def _putc(self, c, flush = False):
-
-        # １文字の出力
-        pyxel.image(0).text(self._cursor_x, self._cursor_y, c, self._color_text)
-
-        # カーソルの更新
-        self._cursor_x = self._cursor_x + self._font_size_x
-        if self._cursor_x >= self._screen_size_x:
-            self._newline()
-        # elif flush:
-        #     pyxel.flip()
+        self._outputs.append(string)
 
     # 改行する
     def _newline(self):
-
-        # スクロール
-        pyxel.image(0).blt(0, 0, 0, 0, self._font_size_y, self._screen_size_x, self._screen_size_y - self._font_size_y)
-        pyxel.image(0).rect(0, self._screen_size_y - self._font_size_y, self._screen_size_x, self._font_size_y, self._color_back)
-        # pyxel.flip()
-
-        # カーソルの更新
-        self._cursor_x = 0
+        self._outputs.append('\n')
 
     # キー入力を受け付ける
     def _input(self):
 
-        # キーコード
-        numbers = {
-            pyxel.KEY_0: '0', 
-            pyxel.KEY_1: '1', 
-            pyxel.KEY_2: '2', 
-            pyxel.KEY_3: '3', 
-            pyxel.KEY_4: '4', 
-            pyxel.KEY_5: '5', 
-            pyxel.KEY_6: '6', 
-            pyxel.KEY_7: '7', 
-            pyxel.KEY_8: '8', 
-            pyxel.KEY_9: '9', 
-            pyxel.KEY_KP_0: '0', 
-            pyxel.KEY_KP_1: '1', 
-            pyxel.KEY_KP_2: '2', 
-            pyxel.KEY_KP_3: '3', 
-            pyxel.KEY_KP_4: '4', 
-            pyxel.KEY_KP_5: '5', 
-            pyxel.KEY_KP_6: '6', 
-            pyxel.KEY_KP_7: '7', 
-            pyxel.KEY_KP_8: '8', 
-            pyxel.KEY_KP_9: '9', 
-        }
-        alphabets = {
-            pyxel.KEY_A: 'A', 
-            pyxel.KEY_B: 'B', 
-            pyxel.KEY_C: 'C', 
-            pyxel.KEY_D: 'D', 
-            pyxel.KEY_E: 'E', 
-            pyxel.KEY_F: 'F', 
-            pyxel.KEY_G: 'G', 
-            pyxel.KEY_H: 'H', 
-            pyxel.KEY_I: 'I', 
-            pyxel.KEY_J: 'J', 
-            pyxel.KEY_K: 'K', 
-            pyxel.KEY_L: 'L', 
-            pyxel.KEY_M: 'M', 
-            pyxel.KEY_N: 'N', 
-            pyxel.KEY_O: 'O', 
-            pyxel.KEY_P: 'P', 
-            pyxel.KEY_Q: 'Q', 
-            pyxel.KEY_R: 'R', 
-            pyxel.KEY_S: 'S', 
-            pyxel.KEY_T: 'T', 
-            pyxel.KEY_U: 'U', 
-            pyxel.KEY_V: 'V', 
-            pyxel.KEY_W: 'W', 
-            pyxel.KEY_X: 'X', 
-            pyxel.KEY_Y: 'Y', 
-            pyxel.KEY_Z: 'Z'
-        }
-
-        # ENTER が押されるまで
-        result = False
-
-        # ENTER の入力
-        if pyxel.btnp(pyxel.KEY_RETURN) or pyxel.btnp(pyxel.KEY_KP_ENTER):
-            if len(self._input_string) > 0:
-                result = True
-
-        # BACKSPACE, DELETE の入力
-        elif pyxel.btnp(pyxel.KEY_BACKSPACE) or pyxel.btnp(pyxel.KEY_DELETE):
-            if len(self._input_string) > 0:
-                self._input_string = self._input_string[:-1]
-                self._cursor_x = self._cursor_x - self._font_size_x
-                pyxel.image(0).rect(self._cursor_x, self._cursor_y, self._font_size_x, self._font_size_y, self._color_back)
-
-        # その他の入力
-        else:
+        # ENTER が押されるまで、打たれた順に文字を取り出す
+        while True:
+            c = self._keyboard.read()
+            if c is None:
+                return False
+
+            # ENTER の入力
+            if c == '\r':
+                if len(self._input_string) > 0:
+                    return True
+
+            # BACKSPACE, DELETE の入力
+            elif c == '\b':
+                if len(self._input_string) > 0:
+                    self._input_string = self._input_string[:-1]
+                    self._outputs.append('\b')
 
             # 数値の入力
-            for key in numbers:
-                if pyxel.btnp(key):
-                    if len(self._input_string) < 8:
-                        c = numbers[key]
-                        self._input_string = self._input_string + c
-                        self._putc(c)
+            elif c.isdecimal():
+                if len(self._input_string) < 8:
+                    self._input_string = self._input_string + c
+                    self._print(c)
 
             # アルファベットの入力
-            for key in alphabets:
-                if pyxel.btnp(key):
-                    if len(self._input_string) == 0:
-                        c = alphabets[key]
-                        self._input_string = c
-                        self._putc(c)
-
-        # 終了
-        return result
+            elif len(self._input_string) == 0:
+                self._input_string = c
+                self._print(c)
 
 # アプリケーションのエントリポイント
 #
 if __name__ == '__main__':
 
+    # 引数の取得
+    parser = argparse.ArgumentParser(description = 'Tiny Trek')
+    parser.add_argument('--thread', action = 'store_true', help = 'run the interpreter on a worker thread instead of inside the frame update')
+    args = parser.parse_args()
+
     # Tiny BASIC の実行
     try:
-        TinyTrek().run("./tinytrek.bas")
+        TinyTrek(threaded = args.thread).run("./tinytrek.bas")
     except Exception as e:
         pass